@@ -0,0 +1,292 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+import click
+
+from .utils import json_encode
+
+
+logger = logging.getLogger(__name__)
+
+
+class Reservoir:
+    """Keep a fixed-size uniform sample of a stream of values."""
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.values = []
+
+    def add(self, value):
+        self.count += 1
+        values = self.values
+        if len(values) < self.size:
+            values.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.size:
+                values[i] = value
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    """Return the given percentiles of some values, and their maximum."""
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {}
+    for point in points:
+        index = min(len(values) - 1, int(len(values) * point / 100))
+        result['p{}'.format(point)] = values[index]
+    result['max'] = values[-1]
+    return result
+
+
+def process_stats(pid):
+    """Return the resident memory in bytes and CPU seconds used by a process."""
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+                break
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+    return rss, cpu
+
+
+class LoadGenerator:
+    """Subscribers and writers run by one benchmark process."""
+
+    encoding = "UTF-8"
+
+    def __init__(self, base_url, subscribers, writers, rate, sample_size, loop=None):
+        self.base_url = base_url
+        self.subscribers = subscribers
+        self.writers = writers
+        self.rate = rate
+        self.loop = loop
+        self.latencies = Reservoir(sample_size)
+        self.received = 0
+        self.sent = 0
+        self.errors = 0
+        self.http = None
+
+    async def subscribe(self, connected):
+        """Open a stream and record the latency of stamped updates.
+
+        The stream's client ID is set as the result of `connected`, or the
+        reason it couldn't be opened as its exception.
+        """
+        try:
+            response = await self.http.get(self.base_url + "/events")
+        except Exception as exc:
+            connected.set_exception(exc)
+            return
+        if 200 != response.status:
+            response.close()
+            connected.set_exception(aiohttp.ClientError("stream refused with status {}".format(response.status)))
+            return
+        connected.set_result(response.headers.get('id'))
+        encoding = self.encoding
+        latencies = self.latencies
+        event_type = None
+        try:
+            while True:
+                line = await response.content.readline()
+                if not line:
+                    break
+                if line.startswith(b"event: "):
+                    event_type = line[7:].strip()
+                elif line.startswith(b"data: ") and b"updated" == event_type:
+                    received = time.time()
+                    text = json.loads(line[6:].decode(encoding)).get('text', "")
+                    if text.startswith("bench "):
+                        latencies.add(received - float(text[6:]))
+                        self.received += 1
+                elif b"\n" == line:
+                    event_type = None
+        finally:
+            response.close()
+
+    async def write(self, client_id, duration):
+        """Update a client at a fixed rate, stamping each update.
+
+        Only updates the server accepted are counted as sent; the rest are
+        counted as errors.
+        """
+        loop = self.loop
+        url = "{}/data/{}".format(self.base_url, client_id)
+        interval = 1 / self.rate
+        deadline = loop.time() + duration
+        next_time = loop.time()
+        while next_time < deadline:
+            data = json_encode(dict(text="bench {!r}".format(time.time())))
+            try:
+                response = await self.http.request("PUT", url, data=data)
+                response.release()
+                if 200 <= response.status < 300:
+                    self.sent += 1
+                else:
+                    self.errors += 1
+            except aiohttp.ClientError:
+                self.errors += 1
+            next_time += interval
+            await asyncio.sleep(max(0, next_time - loop.time()), loop=loop)
+
+    async def run(self, connected, start, duration):
+        """Connect subscribers, report, wait for the go-ahead and write."""
+        loop = self.loop
+        connector = aiohttp.TCPConnector(loop=loop, limit=None)
+        self.http = aiohttp.ClientSession(connector=connector, loop=loop)
+        try:
+            streams = []
+            futures = []
+            for _ in range(self.subscribers + self.writers):
+                future = loop.create_future()
+                streams.append(asyncio.ensure_future(self.subscribe(future), loop=loop))
+                futures.append(future)
+            results = await asyncio.gather(*futures, loop=loop, return_exceptions=True)
+            client_ids = []
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.warning("STREAM FAILED %s", result)
+                    self.errors += 1
+                else:
+                    client_ids.append(result)
+            connected()
+            await loop.run_in_executor(None, start.wait)
+            writers = [self.write(client_id, duration) for client_id in client_ids[:self.writers]]
+            await asyncio.gather(*writers, loop=loop)
+            await asyncio.sleep(1, loop=loop)  # let the last updates arrive
+            for stream in streams:
+                stream.cancel()
+        finally:
+            self.http.close()
+
+
+def run_load(index, options, results, ready, start):
+    """Run one benchmark process's share of the load."""
+    processes = options['processes']
+    subscribers = options['subscribers'] // processes + (index < options['subscribers'] % processes)
+    writers = options['writers'] // processes + (index < options['writers'] % processes)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    generator = LoadGenerator(
+        "http://127.0.0.1:{}".format(options['port']),
+        subscribers,
+        writers,
+        options['rate'],
+        options['sample_size'] // processes,
+        loop=loop
+    )
+    try:
+        loop.run_until_complete(generator.run(ready.release, start, options['duration']))
+    finally:
+        loop.close()
+    results.put(dict(
+        latencies=generator.latencies.values,
+        received=generator.received,
+        sent=generator.sent,
+        errors=generator.errors,
+    ))
+
+
+def wait_for_port(port, timeout=10):
+    """Wait until something accepts connections on a local port."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.option('--logging', '-l', default="WARNING", envvar="BENCH_LOGGING", help="Log level", show_default=True)
+@click.option('--port', '-p', default=8100, envvar="BENCH_PORT", help="Port for the benchmarked server", show_default=True)
+@click.option('--subscribers', '-s', default=1000, envvar="BENCH_SUBSCRIBERS", help="Streams that only read", show_default=True)
+@click.option('--writers', '-w', default=10, envvar="BENCH_WRITERS", help="Streams whose clients are also updated", show_default=True)
+@click.option('--rate', '-r', default=10.0, envvar="BENCH_RATE", help="Updates per second per writer", show_default=True)
+@click.option('--duration', '-d', default=10.0, envvar="BENCH_DURATION", help="Seconds to write for", show_default=True)
+@click.option('--processes', '-P', default=1, envvar="BENCH_PROCESSES", help="Processes generating load", show_default=True)
+@click.option('--sample-size', default=100000, envvar="BENCH_SAMPLE_SIZE", help="Latencies kept for percentiles", show_default=True)
+@click.argument('server_args', nargs=-1, type=click.UNPROCESSED)
+def main(**options):
+    """Benchmark a local event source server and print the results as JSON.
+
+    Extra arguments are passed to the server, e.g. `-- --json-backend orjson`.
+    """
+    logging.basicConfig(level=getattr(logging, options['logging'].upper()))
+    processes = options['processes']
+    port = options['port']
+
+    server = subprocess.Popen(
+        [sys.executable, "-c", "from aioserver.cli import main; main()",
+         "--port", str(port), "--logging", "WARNING"] + list(options['server_args'])
+    )
+    try:
+        wait_for_port(port)
+        rss_idle, _ = process_stats(server.pid)
+
+        results = multiprocessing.Queue()
+        ready = multiprocessing.Semaphore(0)
+        start = multiprocessing.Event()
+        workers = [
+            multiprocessing.Process(target=run_load, args=(i, options, results, ready, start))
+            for i in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for _ in workers:
+            ready.acquire()
+
+        rss_connected, cpu_started = process_stats(server.pid)
+        started = time.monotonic()
+        start.set()
+
+        reports = [results.get() for _ in workers]
+        elapsed = time.monotonic() - started
+        _, cpu_finished = process_stats(server.pid)
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    connections = options['subscribers'] + options['writers']
+    latencies = [latency for report in reports for latency in report['latencies']]
+    received = sum(report['received'] for report in reports)
+    sent = sum(report['sent'] for report in reports)
+    summary = dict(
+        connections=connections,
+        elapsed_seconds=elapsed,
+        updates_sent=sent,
+        updates_per_second=sent / elapsed,
+        events_received=received,
+        events_per_second=received / elapsed,
+        errors=sum(report['errors'] for report in reports),
+        latency_seconds=percentiles(latencies),
+        server_rss_bytes=rss_connected,
+        server_bytes_per_connection=(rss_connected - rss_idle) / connections if connections else None,
+        server_cpu_seconds=cpu_finished - cpu_started,
+        server_cpu_share=(cpu_finished - cpu_started) / elapsed,
+        server_args=list(options['server_args']),
+    )
+    click.echo(json.dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
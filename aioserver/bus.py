@@ -0,0 +1,312 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+
+from .utils import json_dumps
+
+
+logger = logging.getLogger(__name__)
+
+
+# A message is a JSON header and an opaque body, each prefixed by its length.
+_lengths = struct.Struct("!II")
+
+
+def encode_message(header, body=b""):
+    """Return a framed message."""
+    header = json_dumps(header)
+    return b"".join((_lengths.pack(len(header), len(body)), header, body))
+
+
+async def read_message(reader):
+    """Read a framed message, returning the decoded header and the body."""
+    header_length, body_length = _lengths.unpack(await reader.readexactly(_lengths.size))
+    header = json.loads((await reader.readexactly(header_length)).decode("UTF-8"))
+    body = await reader.readexactly(body_length) if body_length else b""
+    return header, body
+
+
+def parse_address(address):
+    """Return a Unix socket path or a (host, port) tuple for a bus address.
+
+    TCP addresses look like `tcp://host:port`; anything else is a path.
+    """
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+def listen(address, backlog=100):
+    """Return a listening socket for a bus address."""
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+class Broker:
+    """Relay messages between the nodes of one server.
+
+    Every message from one node is sent to every other node. When a node
+    disconnects, the others are told with a `gone` message. The broker waits
+    for each node to drain before reading more, so a slow node slows down the
+    nodes publishing to it instead of buffering without limit.
+    """
+
+    def __init__(self, sock, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.sock = sock
+        self.loop = loop
+        self.peers = {}
+        self._server = None
+
+    async def handle(self, reader, writer):
+        """Relay messages from a node until it disconnects."""
+        node_id = None
+        peers = self.peers
+        try:
+            while True:
+                try:
+                    header, body = await read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if node_id is None:
+                    node_id = header['origin']
+                    peers[node_id] = writer
+                    logger.info("JOIN %s", node_id)
+                message = encode_message(header, body)
+                for peer_id, peer in list(peers.items()):
+                    if peer_id != node_id:
+                        peer.write(message)
+                        try:
+                            await peer.drain()
+                        except ConnectionError:
+                            pass  # the peer's own handler cleans up
+        finally:
+            if node_id is not None:
+                del peers[node_id]
+                logger.info("LEAVE %s", node_id)
+                message = encode_message(dict(type="gone", origin=node_id))
+                for peer in peers.values():
+                    peer.write(message)
+            writer.close()
+
+    async def start(self):
+        """Start relaying messages."""
+        assert self._server is None
+        if socket.AF_UNIX == self.sock.family:
+            self._server = await asyncio.start_unix_server(self.handle, sock=self.sock, loop=self.loop)
+        else:
+            self._server = await asyncio.start_server(self.handle, sock=self.sock, loop=self.loop)
+
+    async def stop(self):
+        """Stop relaying messages."""
+        server = self._server
+        assert server is not None
+        server.close()
+        await server.wait_closed()
+        self._server = None
+
+
+class BaseBus:
+    """An abstract connection between the nodes of one server.
+
+    A bus carries messages made of a small JSON-serializable header and an
+    already-encoded body. Every message is seen by every other node, unless
+    its header names one node in `to`.
+
+    A bus that loses its connection tells its own node with a
+    `disconnected` message, and with a `connected` message once it's back.
+    """
+
+    def __init__(self, node_id=None, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        if node_id is None:
+            node_id = "{}.{}".format(socket.gethostname(), os.getpid())
+        self.node_id = node_id
+        self.loop = loop
+        self._handler = None
+
+    async def connect(self, handler):
+        """Connect and call `handler(header, body)` for each message.
+
+        The other nodes are sent a `hello` message.
+        """
+        raise NotImplementedError()
+
+    def publish(self, header, body=b""):
+        """Send a message to the other nodes without waiting."""
+        raise NotImplementedError()
+
+    async def drain(self):
+        """Wait until published messages have been handed off."""
+
+    async def close(self):
+        """Disconnect from the other nodes."""
+        raise NotImplementedError()
+
+    def _handle(self, header, body):
+        to = header.get('to')
+        if self._handler is None or (to is not None and to != self.node_id):
+            return
+        try:
+            self._handler(header, body)
+        except Exception:
+            logger.exception("BUS MESSAGE FAILED %s", header)
+
+
+class MemoryHub:
+    """Connect the memory buses of one process, on any event loop or thread."""
+
+    def __init__(self):
+        self.nodes = {}
+        self._lock = threading.Lock()
+
+    def add(self, bus):
+        with self._lock:
+            self.nodes[bus.node_id] = bus
+
+    def remove(self, bus):
+        with self._lock:
+            self.nodes.pop(bus.node_id, None)
+
+    def send(self, sender, header, body):
+        with self._lock:
+            nodes = list(self.nodes.values())
+        for node in nodes:
+            if node is not sender:
+                node.loop.call_soon_threadsafe(node._handle, header, body)
+
+
+class MemoryBus(BaseBus):
+    """A bus between nodes in the same process."""
+
+    def __init__(self, hub, node_id=None, loop=None):
+        if node_id is None:
+            node_id = "{}.{}.{}".format(socket.gethostname(), os.getpid(), id(self))
+        super().__init__(node_id=node_id, loop=loop)
+        self.hub = hub
+
+    async def connect(self, handler):
+        assert self._handler is None
+        self._handler = handler
+        self.hub.add(self)
+        self.publish(dict(type="hello"))
+
+    def publish(self, header, body=b""):
+        header['origin'] = self.node_id
+        self.hub.send(self, header, body)
+
+    async def close(self):
+        if self._handler is None:
+            return
+        self.hub.remove(self)
+        self.publish(dict(type="gone"))
+        self._handler = None
+
+
+class Bus(BaseBus):
+    """A node's connection to a broker over a Unix socket or TCP.
+
+    Messages published in the same loop iteration are written together, and
+    `drain` waits while the connection's write buffer is full. If the broker
+    goes away, the bus reconnects, waiting longer after each failed attempt
+    up to `max_reconnect_delay` seconds; messages published in the meantime
+    are dropped.
+    """
+
+    reconnect_delay = 0.1
+    max_reconnect_delay = 10
+
+    def __init__(self, address, node_id=None, loop=None):
+        super().__init__(node_id=node_id, loop=loop)
+        self.address = address
+        self._writer = None
+        self._receiver = None
+        self._pending = []
+
+    async def connect(self, handler):
+        assert self._writer is None
+        self._handler = handler
+        reader, self._writer = await self._open()
+        self._receiver = asyncio.ensure_future(self._receive(reader), loop=self.loop)
+        self.publish(dict(type="hello"))
+
+    async def _open(self):
+        address = parse_address(self.address)
+        if isinstance(address, tuple):
+            return await asyncio.open_connection(*address, loop=self.loop)
+        return await asyncio.open_unix_connection(address, loop=self.loop)
+
+    async def _receive(self, reader):
+        while True:
+            try:
+                header, body = await read_message(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.warning("BUS CLOSED %s", self.address)
+                self._writer.close()
+                self._writer = None
+                self._handle(dict(type="disconnected", origin=self.node_id), b"")
+                reader = await self._reconnect()
+                continue
+            self._handle(header, body)
+
+    async def _reconnect(self):
+        """Connect to the broker again and return the new reader."""
+        delay = self.reconnect_delay
+        while True:
+            await asyncio.sleep(delay, loop=self.loop)
+            try:
+                reader, writer = await self._open()
+            except OSError as exc:
+                logger.warning("BUS RECONNECT FAILED %s %s", self.address, exc)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            logger.info("BUS RECONNECTED %s", self.address)
+            self._writer = writer
+            self.publish(dict(type="hello"))
+            self._handle(dict(type="connected", origin=self.node_id), b"")
+            return reader
+
+    def publish(self, header, body=b""):
+        header['origin'] = self.node_id
+        pending = self._pending
+        if not pending:
+            self.loop.call_soon(self._flush)
+        pending.append(encode_message(header, body))
+
+    def _flush(self):
+        pending = self._pending
+        writer = self._writer
+        if pending and writer is not None:
+            writer.write(b"".join(pending))
+        pending.clear()
+
+    async def drain(self):
+        self._flush()
+        writer = self._writer
+        if writer is not None:
+            await writer.drain()
+
+    async def close(self):
+        receiver = self._receiver
+        if receiver is not None:
+            receiver.cancel()
+            self._receiver = None
+        writer = self._writer
+        if writer is not None:
+            self._flush()
+            writer.close()
+            self._writer = None
@@ -1,23 +1,333 @@
 import asyncio
 import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
 
 import click
 
-from .server import Server
+from .bus import Broker, Bus, MemoryBus, MemoryHub, listen
+from .journal import Journal
+from .profiler import Profiler
+from .server import DROP_OLDEST, OVERFLOW_POLICIES, Server
+from .shards import Listener, Shard
+from .utils import json_backends, set_json_backend
 
 
+logger = logging.getLogger(__name__)
+
 @click.command()
 @click.option('--logging', '-l', default="INFO", envvar="SERVER_LOGGING", help="Log level", show_default=True)
 @click.option('--debug', '-d', envvar="SERVER_DEBUG", is_flag=True, help="Enable debugging", show_default=True)
 @click.option('--address', '-a', default="127.0.0.1", envvar="SERVER_ADDRESS", help="Server address", show_default=True)
 @click.option('--port', '-p', default=8000, envvar="SERVER_PORT", help="Server port", show_default=True)
+@click.option('--log-size', default=1000, envvar="SERVER_LOG_SIZE", help="Number of recent events kept for slow and reconnecting clients", show_default=True)
+@click.option('--overflow', default=DROP_OLDEST, type=click.Choice(OVERFLOW_POLICIES), envvar="SERVER_OVERFLOW", help="What to do when a client falls behind the event log", show_default=True)
+@click.option('--batch-size', default=100, envvar="SERVER_BATCH_SIZE", help="Maximum events per write", show_default=True)
+@click.option('--batch-bytes', default=64 * 1024, envvar="SERVER_BATCH_BYTES", help="Approximate maximum bytes per write", show_default=True)
+@click.option('--flush-interval', default=0.0, envvar="SERVER_FLUSH_INTERVAL", help="Seconds to wait for more events before writing", show_default=True)
+@click.option('--compression-level', default=0, type=click.IntRange(0, 9), envvar="SERVER_COMPRESSION_LEVEL", help="Compress streams for clients that accept it (0 to disable)", show_default=True)
+@click.option('--compression-window-bits', default=15, type=click.IntRange(9, 15), envvar="SERVER_COMPRESSION_WINDOW_BITS", help="Compression window size; smaller uses less memory per stream", show_default=True)
+@click.option('--compression-budget', default=0.25, envvar="SERVER_COMPRESSION_BUDGET", help="Stop compressing new streams above this share of time spent compressing", show_default=True)
+@click.option('--json-backend', default="json", type=click.Choice(list(json_backends)), envvar="SERVER_JSON_BACKEND", help="JSON encoder", show_default=True)
+@click.option('--loop', 'loop_name', default="asyncio", type=click.Choice(["asyncio", "uvloop"]), envvar="SERVER_LOOP", help="Event loop implementation", show_default=True)
+@click.option('--backlog', default=100, envvar="SERVER_BACKLOG", help="Listen backlog", show_default=True)
+@click.option('--tcp-nodelay/--no-tcp-nodelay', default=None, envvar="SERVER_TCP_NODELAY", help="Disable Nagle's algorithm on connections")
+@click.option('--send-buffer', default=0, envvar="SERVER_SEND_BUFFER", help="Socket send buffer size in bytes (0 for the system default)", show_default=True)
+@click.option('--tcp-keepalive', default=None, type=int, envvar="SERVER_TCP_KEEPALIVE", help="Seconds idle before TCP keep-alive probes (0 to disable)")
+@click.option('--keepalive-timeout', default=75.0, envvar="SERVER_KEEPALIVE_TIMEOUT", help="Seconds to keep idle HTTP connections open", show_default=True)
+@click.option('--slow-request-timeout', default=0.0, envvar="SERVER_SLOW_REQUEST_TIMEOUT", help="Seconds to wait for a request to arrive (0 to wait forever)", show_default=True)
+@click.option('--reconnect-rate', default=0.0, envvar="SERVER_RECONNECT_RATE", help="Streams opened per second above which the advertised retry grows (0 to keep it fixed)", show_default=True)
+@click.option('--retry-jitter', default=0.5, envvar="SERVER_RETRY_JITTER", help="Random share added to or taken from the advertised retry", show_default=True)
+@click.option('--drain-time', default=10.0, envvar="SERVER_DRAIN_TIME", help="Seconds to spend closing streams on SIGTERM", show_default=True)
+@click.option('--drain-waves', default=10, envvar="SERVER_DRAIN_WAVES", help="Groups of streams closed one after another on SIGTERM", show_default=True)
+@click.option('--max-connections', default=0, envvar="SERVER_MAX_CONNECTIONS", help="Maximum open streams per worker or shard (0 for no limit)", show_default=True)
+@click.option('--max-connections-per-ip', default=0, envvar="SERVER_MAX_CONNECTIONS_PER_IP", help="Maximum open streams from one IP address per worker or shard (0 for no limit)", show_default=True)
+@click.option('--update-rate', default=0.0, envvar="SERVER_UPDATE_RATE", help="Updates broadcast per second per client; faster updates are merged (0 for no limit)", show_default=True)
+@click.option('--update-burst', default=1, envvar="SERVER_UPDATE_BURST", help="Updates per client broadcast at once before the rate applies", show_default=True)
+@click.option('--journal', type=click.Path(file_okay=False), envvar="SERVER_JOURNAL", help="Directory to journal events in, to resume from after a restart")
+@click.option('--journal-snapshot-interval', default=300.0, envvar="SERVER_JOURNAL_SNAPSHOT_INTERVAL", help="Seconds between snapshots of every client's data in the journal", show_default=True)
+@click.option('--profile', is_flag=True, envvar="SERVER_PROFILE", help="Sample where time goes; see GET /debug/profile")
+@click.option('--profile-interval', default=0.005, envvar="SERVER_PROFILE_INTERVAL", help="Seconds of CPU time between profile samples", show_default=True)
+@click.option('--profile-dir', default=tempfile.gettempdir(), type=click.Path(file_okay=False), envvar="SERVER_PROFILE_DIR", help="Directory each process saves its profile in on SIGUSR1", show_default=True)
+@click.option('--slow-callback', default=0.1, envvar="SERVER_SLOW_CALLBACK", help="Seconds the event loop may be blocked before the blocking stack is logged when profiling (0 to disable)", show_default=True)
+@click.option('--workers', '-w', default=1, envvar="SERVER_WORKERS", help="Number of worker processes", show_default=True)
+@click.option('--shards', default=1, envvar="SERVER_SHARDS", help="Event loop threads per process, each serving a share of the connections", show_default=True)
+@click.option('--bus', envvar="SERVER_BUS", help="Address of a broker shared with other servers (path or tcp://host:port)")
 def main(**options):
     """Run an event source server."""
     logging.basicConfig(level=getattr(logging, options['logging'].upper()))
+    set_json_backend(options['json_backend'])
+    set_loop_policy(options['loop_name'])
+    if options['shards'] > 1 and options['profile']:
+        raise click.UsageError("--profile only samples the main thread, so can't be used with --shards")
+    workers = options['workers']
+    if workers > 1:
+        run_workers(workers, options)
+    else:
+        run_server(options, bus_address=options['bus'])
+
+
+def set_loop_policy(name):
+    """Select the event loop implementation."""
+    if "uvloop" == name:
+        try:
+            import uvloop
+        except ImportError:
+            raise click.UsageError("uvloop isn't installed")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def make_server(options, loop, bus=None, listen=True, reuse_port=False):
+    """Return a server configured by the command line options."""
+    profiler = None
+    if options['profile']:
+        profiler = Profiler(interval=options['profile_interval'], slow_callback=options['slow_callback'], loop=loop)
+    journal = None
+    if options['journal'] is not None:
+        journal = Journal(options['journal'], snapshot_interval=options['journal_snapshot_interval'], loop=loop)
+    return Server(
+        options['address'],
+        options['port'],
+        log_size=options['log_size'],
+        overflow=options['overflow'],
+        batch_size=options['batch_size'],
+        batch_bytes=options['batch_bytes'],
+        flush_interval=options['flush_interval'],
+        compression_level=options['compression_level'],
+        compression_window_bits=options['compression_window_bits'],
+        compression_budget=options['compression_budget'],
+        bus=bus,
+        journal=journal,
+        profiler=profiler,
+        listen=listen,
+        reuse_port=reuse_port,
+        backlog=options['backlog'],
+        tcp_nodelay=options['tcp_nodelay'],
+        send_buffer=options['send_buffer'],
+        tcp_keepalive=options['tcp_keepalive'],
+        keepalive_timeout=options['keepalive_timeout'],
+        slow_request_timeout=options['slow_request_timeout'],
+        reconnect_rate=options['reconnect_rate'],
+        retry_jitter=options['retry_jitter'],
+        drain_time=options['drain_time'],
+        drain_waves=options['drain_waves'],
+        max_connections=options['max_connections'],
+        max_connections_per_ip=options['max_connections_per_ip'],
+        update_rate=options['update_rate'],
+        update_burst=options['update_burst'],
+        loop=loop
+    )
+
+
+def run_server(options, bus_address=None, reuse_port=False):
+    """Run a server until interrupted or drained, optionally connected to a broker."""
+    if options['shards'] > 1:
+        run_shards(options, bus_address=bus_address, reuse_port=reuse_port)
+        return
     loop = asyncio.get_event_loop()
     loop.set_debug(options['debug'])
-    server = Server(options['address'], options['port'], loop=loop)
+    bus = None
+    if bus_address is not None:
+        bus = Bus(bus_address, loop=loop)
+    server = make_server(options, loop, bus=bus, reuse_port=reuse_port)
+    journal = server.journal
+    profiler = server.profiler
+
+    async def shutdown():
+        await server.drain()
+        await server.stop()
+        loop.stop()
+
+    def terminate():
+        loop.remove_signal_handler(signal.SIGTERM)
+        asyncio.ensure_future(shutdown(), loop=loop)
+
     loop.run_until_complete(server.start())
+    # Drain on SIGTERM; stop at once on Ctrl-C.
+    loop.add_signal_handler(signal.SIGTERM, terminate)
+    if profiler is not None:
+        loop.add_signal_handler(signal.SIGUSR1, profiler.save, options['profile_dir'])
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        loop.stop()
+    finally:
+        if journal is not None:
+            journal.close()  # write what's pending
+        loop.close()
+
+
+def run_shards(options, bus_address=None, reuse_port=False):
+    """Run servers on several event loops in threads, behind one listener.
+
+    The listener accepts connections in this thread and hands them to the
+    shards in turn. The shards share events through a bus in memory, or are
+    each a node of a broker's if one is given.
+    """
+    hub = MemoryHub()
+    shards = []
+    for i in range(options['shards']):
+        loop = asyncio.new_event_loop()
+        loop.set_debug(options['debug'])
+        if bus_address is not None:
+            bus = Bus(bus_address, node_id="{}.{}.{}".format(socket.gethostname(), os.getpid(), i), loop=loop)
+        else:
+            bus = MemoryBus(hub, loop=loop)
+        shard_options = options
+        if options['journal'] is not None:
+            # Each shard keeps its own journal.
+            shard_options = dict(options, journal=os.path.join(options['journal'], str(i)))
+        server = make_server(shard_options, loop, bus=bus, listen=False)
+        shards.append(Shard(server, name="aioserver-shard-{}".format(i)))
+
+    loop = asyncio.get_event_loop()
+    listener = Listener(
+        shards,
+        options['address'],
+        options['port'],
+        backlog=options['backlog'],
+        reuse_port=reuse_port,
+        loop=loop
+    )
+
+    def stop(drain):
+        # Keep accepting while draining, so new streams are told to come back later.
+        if drain:
+            for future in [shard.submit(shard.server.drain()) for shard in shards]:
+                future.result()
+        for shard in shards:
+            shard.stop()
+        listener.stop()
+
+    async def shutdown():
+        await loop.run_in_executor(None, stop, True)
+        loop.stop()
+
+    def terminate():
+        loop.remove_signal_handler(signal.SIGTERM)
+        asyncio.ensure_future(shutdown(), loop=loop)
+
+    for shard in shards:
+        shard.start()
+    listener.start()
+    # Drain on SIGTERM; stop at once on Ctrl-C.
+    loop.add_signal_handler(signal.SIGTERM, terminate)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        stop(False)
+    finally:
+        loop.close()
+
+
+def run_workers(workers, options):
+    """Fork worker processes that share a port and talk through a broker.
+
+    If a shared broker is given, the workers connect to it instead of to one
+    run by this process. SIGTERM is passed on to the workers, and this
+    process exits once they've drained; SIGUSR1 is passed on too. If every
+    worker exits without being asked to, this process exits with status 1.
+    """
+    bus_address = options['bus']
+    if bus_address is not None:
+        sock = None
+    else:
+        bus_dir = tempfile.mkdtemp(prefix="aioserver-")
+        bus_address = os.path.join(bus_dir, "bus.sock")
+        sock = listen(bus_address, workers)
+
+    # Fork before creating an event loop so workers don't share one.
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if 0 == pid:
+            if sock is not None:
+                sock.close()
+            if options['journal'] is not None:
+                # Each worker keeps its own journal.
+                options = dict(options, journal=os.path.join(options['journal'], str(i)))
+            status = 1
+            try:
+                run_server(options, bus_address=bus_address, reuse_port=True)
+                status = 0
+            except Exception:
+                logger.exception("WORKER FAILED %d", os.getpid())
+            finally:
+                os._exit(status)
+        pids.append(pid)
+
+    loop = asyncio.get_event_loop()
+    terminating = False
+    failed = False
+
+    def reap():
+        # Stop once every worker has exited.
+        nonlocal failed
+        for pid in list(pids):
+            exited, status = os.waitpid(pid, os.WNOHANG)
+            if exited:
+                pids.remove(pid)
+                code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                if code or not terminating:
+                    logger.error("WORKER EXITED %d with status %d", pid, code)
+        if not pids:
+            failed = not terminating
+            loop.stop()
+
+    def terminate():
+        # Let the workers drain, relaying their events until they've exited.
+        nonlocal terminating
+        terminating = True
+        loop.remove_signal_handler(signal.SIGTERM)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    def save_profiles():
+        # Each worker writes its own profile.
+        if options['profile']:
+            for pid in pids:
+                os.kill(pid, signal.SIGUSR1)
+
+    loop.add_signal_handler(signal.SIGCHLD, reap)
+    loop.add_signal_handler(signal.SIGTERM, terminate)
+    loop.add_signal_handler(signal.SIGUSR1, save_profiles)
+    loop.call_soon(reap)  # in case a worker already exited
+    try:
+        if sock is not None:
+            broker = Broker(sock, loop=loop)
+            loop.run_until_complete(broker.start())
+        loop.run_forever()
+    except KeyboardInterrupt:
+        loop.stop()
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+        loop.close()
+        if sock is not None:
+            os.unlink(bus_address)
+            os.rmdir(bus_dir)
+    if failed:
+        # Every worker died without being asked to.
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--logging', '-l', default="INFO", envvar="BROKER_LOGGING", help="Log level", show_default=True)
+@click.option('--address', '-a', default="tcp://127.0.0.1:8001", envvar="BROKER_ADDRESS", help="Broker address (path or tcp://host:port)", show_default=True)
+def broker_main(**options):
+    """Relay events between servers."""
+    logging.basicConfig(level=getattr(logging, options['logging'].upper()))
+    loop = asyncio.get_event_loop()
+    broker = Broker(listen(options['address']), loop=loop)
+    loop.run_until_complete(broker.start())
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -0,0 +1,89 @@
+import collections
+import logging
+import time
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+
+# Content codings we can produce, most preferred first, with their zlib
+# container (added to the window size).
+ENCODINGS = collections.OrderedDict((
+    ('gzip', 16),
+    ('deflate', 0),
+))
+
+
+def negotiate(accept_encoding):
+    """Return the preferred content coding a client accepts, or None."""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if 0 == float(params[2:]):
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    for coding in ENCODINGS:
+        if coding in accepted:
+            return coding
+    return None
+
+
+class Compressor:
+    """Compress one stream, flushing after every write so nothing is held back.
+
+    The compressor keeps its dictionary for the life of the stream, so
+    repeated field names and values compress well across events.
+    """
+
+    def __init__(self, encoding, level=6, window_bits=15, mem_level=8, stats=None):
+        self.encoding = encoding
+        self.stats = stats if stats is not None else collections.Counter()
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding] + window_bits, mem_level)
+
+    def compress(self, data):
+        """Return the compressed data, flushed to a byte boundary."""
+        started = time.perf_counter()
+        compressobj = self._compressobj
+        compressed = compressobj.compress(data) + compressobj.flush(zlib.Z_SYNC_FLUSH)
+        stats = self.stats
+        stats['compression_seconds'] += time.perf_counter() - started
+        stats['compression_bytes_in'] += len(data)
+        stats['compression_bytes_out'] += len(compressed)
+        return compressed
+
+
+class CompressionBudget:
+    """Limit the share of time spent compressing.
+
+    Time spent is measured over fixed windows. While the share of the last
+    complete window is over budget, no new streams should be compressed;
+    streams that are already compressed stay that way.
+    """
+
+    def __init__(self, share, stats, window=10, clock=time.monotonic):
+        self.share = share
+        self.stats = stats
+        self.window = window
+        self.clock = clock
+        self._started = clock()
+        self._spent = stats['compression_seconds']
+        self._last_share = 0
+
+    def allows(self):
+        """Return True if a new stream may be compressed."""
+        now = self.clock()
+        elapsed = now - self._started
+        if elapsed >= self.window:
+            spent = self.stats['compression_seconds']
+            self._last_share = (spent - self._spent) / elapsed
+            self._started = now
+            self._spent = spent
+            if self._last_share >= self.share:
+                logger.warning("COMPRESSION OVER BUDGET %.2f", self._last_share)
+        return self._last_share < self.share
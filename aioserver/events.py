@@ -1,7 +1,7 @@
-import io
 import logging
 
-from .utils import json_encode
+from .utils import json_dumps
+from .websocket import encode_event
 
 
 logger = logging.getLogger(__name__)
@@ -14,75 +14,191 @@ class BaseEvent:
     _payload = None
 
     def encode(self):
+        """Return the encoded event as bytes."""
         raise NotImplementedError()
 
-    def dump(self, response):
-        """Encode the event and write the payload to a file-like object."""
+    @property
+    def payload(self):
+        """Return the encoded event, encoding it only the first time."""
         payload = self._payload
         if payload is None:
-            payload = self.encode().encode(self.encoding)
+            payload = self.encode()
             self._payload = payload
-        response.write(payload)
+        return payload
+
+    def dump(self, response):
+        """Encode the event and write the payload to a file-like object."""
+        response.write(self.payload)
 
 
 class Event(BaseEvent):
-    """A JSON-encoded event source data message."""
+    """A JSON-encoded event source data message.
+
+    An update added to a log knows the state it changes, as `base`, a
+    `(seq, event_type, data)` tuple, so it can also be encoded as a delta.
+    """
+
+    seq = None   # sequence number in a log
+    base = None
+    _frame = None
+    _delta_json = None
+    _delta_payload = None
+    _delta_frame = None
 
-    def __init__(self, data, event_id=None, event_type=None):
+    def __init__(self, data, event_id=None, event_type=None, json=None):
         self.data = data
         self.event_id = event_id
         self.event_type = event_type
+        self._json = json  # already-encoded data, if known
+
+    @property
+    def json(self):
+        """Return the JSON-encoded data, encoding it only the first time."""
+        json = self._json
+        if json is None:
+            json = json_dumps(self.data)
+            self._json = json
+        return json
+
+    @property
+    def frame(self):
+        """Return the event as a WebSocket frame, encoding it only the first time."""
+        frame = self._frame
+        if frame is None:
+            frame = encode_event(self.event_type, self.json, self.event_id)
+            self._frame = frame
+        return frame
+
+    @property
+    def delta_json(self):
+        """Return the JSON-encoded data that changed since `base`.
+
+        The client ID is always included.
+        """
+        json = self._delta_json
+        if json is None:
+            base_data = self.base[2]
+            json = json_dumps({key: value for key, value in self.data.items() if 'id' == key or base_data.get(key) != value})
+            self._delta_json = json
+        return json
+
+    @property
+    def delta_payload(self):
+        """Return the event encoded with only the data that changed since `base`."""
+        payload = self._delta_payload
+        if payload is None:
+            payload = self._encode(self.delta_json)
+            self._delta_payload = payload
+        return payload
+
+    @property
+    def delta_frame(self):
+        """Return a WebSocket frame with only the data that changed since `base`."""
+        frame = self._delta_frame
+        if frame is None:
+            frame = encode_event(self.event_type, self.delta_json, self.event_id)
+            self._delta_frame = frame
+        return frame
 
     def encode(self):
         """Return an encoded event source data message."""
-        text_buffer = io.StringIO()
+        return self._encode(self.json)
+
+    def _encode(self, json):
+        parts = []
 
         event_id = self.event_id
         if event_id is not None:
-            text_buffer.write("id: {}\n".format(event_id))
+            parts.append("id: {}\n".format(event_id).encode(self.encoding))
 
         event_type = self.event_type
         if event_type is not None:
-            text_buffer.write("event: {}\n".format(event_type))
+            parts.append("event: {}\n".format(event_type).encode(self.encoding))
+
+        # Compact JSON never spans more than one line.
+        parts.append(b"data: ")
+        parts.append(json)
+        parts.append(b"\n\n")
+        return b"".join(parts)
+
+
+class SnapshotEvent(BaseEvent):
+    """An event source message listing already JSON-encoded items."""
+
+    event_type = "snapshot"
+    _frame = None
 
-        event_text = json_encode(self.data)
-        for line in event_text.splitlines():
-            text_buffer.write("data: {}\n".format(line))
+    def __init__(self, items, event_id=None):
+        self.items = items
+        self.event_id = event_id
+
+    @property
+    def frame(self):
+        """Return the snapshot as a WebSocket frame, encoding it only the first time."""
+        frame = self._frame
+        if frame is None:
+            frame = encode_event(self.event_type, b"[" + b",".join(self.items) + b"]", self.event_id)
+            self._frame = frame
+        return frame
+
+    def encode(self):
+        """Return an encoded event source snapshot message."""
+        parts = []
+
+        event_id = self.event_id
+        if event_id is not None:
+            parts.append("id: {}\n".format(event_id).encode(self.encoding))
 
-        text_buffer.write("\n")
-        return text_buffer.getvalue()
+        parts.append(b"event: snapshot\ndata: [")
+        parts.append(b",".join(self.items))
+        parts.append(b"]\n\n")
+        return b"".join(parts)
 
 
 class CommentEvent(BaseEvent):
     """A event source comment."""
 
+    _empty_payload = b":\n\n"
+
     def __init__(self, message=""):
         self.message = message
+        if not message:
+            self._payload = self._empty_payload
 
     def encode(self):
         """Return an encoded event source comment message."""
-        text_buffer = io.StringIO()
-
         message = self.message
-        if message:
-            for line in message.splitlines():
-                text_buffer.write(": {}\n".format(line))
-        else:
-            text_buffer.write(":\n")
-
-        text_buffer.write("\n")
-        return text_buffer.getvalue()
+        if not message:
+            return self._empty_payload
+        lines = (": {}\n".format(line) for line in message.splitlines())
+        return "{}\n".format("".join(lines)).encode(self.encoding)
 
 
 class RetryEvent(BaseEvent):
     """An event source retry instruction."""
 
     _multiplier = 1000  # specify wait in seconds, but send milliseconds
+    _payloads = {}      # encoded instructions shared between instances
 
     def __init__(self, wait):
         self.wait = wait
 
+    @property
+    def payload(self):
+        payloads = self._payloads
+        wait = self.wait
+        try:
+            return payloads[wait]
+        except KeyError:
+            payload = self.encode()
+            if len(payloads) < 1000:
+                payloads[wait] = payload
+            return payload
+
     def encode(self):
         """Return an encoded event source retry message."""
         wait = int(self._multiplier * self.wait)
-        return "retry: {}\n\n".format(wait)
+        return "retry: {}\n\n".format(wait).encode(self.encoding)
+
+
+HEARTBEAT = CommentEvent()
@@ -0,0 +1,284 @@
+import array
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+
+# Event types are stored as one byte.
+EVENT_TYPES = ("created", "updated", "deleted")
+_type_codes = {event_type: code for code, event_type in enumerate(EVENT_TYPES, 1)}
+
+# For each event: where its payload ends, the length of its JSON data and
+# its type.
+_index_record = struct.Struct("!QIB")
+
+
+class Segment:
+    """Part of a journal: the encoded events from one sequence number on.
+
+    Payloads are stored back to back in an events file, exactly as they're
+    sent, so any run of them can be sent straight from the mapped file. A
+    separate index file records where each one ends.
+    """
+
+    def __init__(self, directory, start):
+        name = "{:020d}".format(start)
+        self.events_path = os.path.join(directory, name + ".events")
+        self.index_path = os.path.join(directory, name + ".index")
+        self.start = start
+        self.ends = array.array('Q')
+        self._events = None
+        self._index = None
+        self._map = None
+
+    @property
+    def last_id(self):
+        """Return the sequence number of the last event in the segment."""
+        return self.start + len(self.ends) - 1
+
+    def load(self):
+        """Read the index, dropping anything a crash left half written.
+
+        Return the JSON length and event type of each event.
+        """
+        with open(self.index_path, "rb") as f:
+            index = f.read()
+        size = os.path.getsize(self.events_path)
+        records = []
+        ends = self.ends
+        end = 0
+        for offset in range(0, len(index) - _index_record.size + 1, _index_record.size):
+            next_end, json_length, code = _index_record.unpack_from(index, offset)
+            if next_end < end or next_end > size:
+                break
+            end = next_end
+            ends.append(end)
+            records.append((json_length, code))
+        if end != size or len(ends) * _index_record.size != len(index):
+            logger.warning("JOURNAL TRUNCATED %s at event %d", self.events_path, self.last_id)
+            os.truncate(self.events_path, end)
+            os.truncate(self.index_path, len(ends) * _index_record.size)
+        return records
+
+    def open(self):
+        """Open the segment for appending."""
+        self._events = open(self.events_path, "ab", buffering=0)
+        self._index = open(self.index_path, "ab", buffering=0)
+
+    def close(self):
+        """Stop appending to the segment."""
+        if self._events is not None:
+            self._events.close()
+            self._index.close()
+            self._events = None
+            self._index = None
+        # Views of the map may still be being sent; it's closed when they're done.
+        self._map = None
+
+    def write(self, records):
+        """Append payloads, given with the length of their JSON data and their type."""
+        ends = self.ends
+        end = ends[-1] if ends else 0
+        index = []
+        for payload, json_length, code in records:
+            end += len(payload)
+            ends.append(end)
+            index.append(_index_record.pack(end, json_length, code))
+        self._events.write(b"".join(payload for payload, _, _ in records))
+        self._index.write(b"".join(index))
+
+    def view(self, first, last):
+        """Return a view of the mapped payloads of some events, inclusive."""
+        ends = self.ends
+        start = ends[first - self.start - 1] if first > self.start else 0
+        end = ends[last - self.start]
+        mapped = self._map
+        if mapped is None or len(mapped) < end:
+            with open(self.events_path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map = mapped
+        return memoryview(mapped)[start:end]
+
+    def remove(self):
+        """Delete the segment's files."""
+        self.close()
+        for path in (self.events_path, self.index_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class Journal:
+    """An append-only record of a server's events, kept in a directory.
+
+    Encoded events are appended in batches, at most `flush_delay` seconds
+    after they're added. A snapshot of every client's data is written now
+    and then; each snapshot starts a new segment and removes all but the
+    previous one, so events since the previous snapshot can be replayed to
+    reconnecting clients. The log's epoch is kept too, so event IDs stay
+    valid across restarts.
+    """
+
+    flush_delay = 0.05
+
+    def __init__(self, path, snapshot_interval=300, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.loop = loop
+        self.epoch = None
+        self.last_id = 0
+        self.registry = collections.OrderedDict()  # encoded data of every client, when opened
+        self._segments = []
+        self._pending = []
+        self._handle = None
+
+    def open(self, epoch):
+        """Restore the epoch, the last event's sequence number and the registry.
+
+        A new journal uses the given epoch.
+        """
+        path = self.path
+        os.makedirs(path, exist_ok=True)
+
+        epoch_path = os.path.join(path, "epoch")
+        try:
+            with open(epoch_path) as f:
+                saved = f.read().strip()
+        except FileNotFoundError:
+            saved = None
+        if saved is not None and "." in saved:
+            epoch = saved
+        else:
+            # Epochs without random bits may be shared with another worker's
+            # journal. Events after this point get IDs in the new epoch, so
+            # nothing journaled under the old one is replayed by mistake.
+            if saved is not None:
+                logger.warning("JOURNAL EPOCH %s replaced by %s", saved, epoch)
+            with open(epoch_path, "w") as f:
+                f.write(epoch + "\n")
+        self.epoch = epoch
+
+        registry = self.registry
+        last_id = 0
+        try:
+            with open(os.path.join(path, "snapshot"), "rb") as f:
+                last_id = json.loads(f.readline().decode("UTF-8"))['seq']
+                for line in f:
+                    item = line.rstrip(b"\n")
+                    registry[json.loads(item.decode("UTF-8"))['id']] = item
+        except FileNotFoundError:
+            pass
+
+        starts = sorted(int(name[:-len(".index")]) for name in os.listdir(path) if name.endswith(".index"))
+        for start in starts:
+            segment = Segment(path, start)
+            records = segment.load()
+            self._segments.append(segment)
+            if segment.last_id <= last_id:
+                continue
+            # Replay what happened since the snapshot.
+            with open(segment.events_path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for seq, end, (json_length, code) in zip(itertools.count(start), segment.ends, records):
+                    if seq <= last_id:
+                        continue
+                    data = mapped[end - 2 - json_length:end - 2]  # the payload ends with the data and a blank line
+                    client_id = json.loads(data.decode("UTF-8"))['id']
+                    event_type = EVENT_TYPES[code - 1] if code else None
+                    if "deleted" == event_type:
+                        registry.pop(client_id, None)
+                    elif event_type is not None:
+                        registry[client_id] = data
+            finally:
+                mapped.close()
+            last_id = segment.last_id
+        self.last_id = last_id
+
+        segments = self._segments
+        if not segments or segments[-1].last_id != last_id:
+            segments.append(Segment(path, last_id + 1))
+        segments[-1].open()
+        logger.info("JOURNAL %s at event %d with %d clients", path, last_id, len(registry))
+
+    def append(self, event):
+        """Add an event, to be written with others shortly."""
+        pending = self._pending
+        if not pending:
+            self._handle = self.loop.call_later(self.flush_delay, self.flush)
+        pending.append((event.payload, len(event.json), _type_codes.get(event.event_type, 0)))
+        self.last_id += 1
+
+    def flush(self):
+        """Write the events added since the last flush."""
+        handle = self._handle
+        if handle is not None:
+            handle.cancel()
+            self._handle = None
+        pending = self._pending
+        if pending:
+            self._segments[-1].write(pending)
+            pending.clear()
+
+    def has(self, cursor):
+        """Return True if the journal has every event after a sequence number."""
+        segments = self._segments
+        return bool(segments) and cursor + 1 >= segments[0].start
+
+    def read(self, cursor, end):
+        """Return views of the encoded events after `cursor` up to `end`.
+
+        Return None if the journal no longer has all of them.
+        """
+        segments = self._segments
+        if not segments or cursor + 1 < segments[0].start or end > self.last_id:
+            return None
+        self.flush()
+        views = []
+        for segment in segments:
+            first = max(cursor + 1, segment.start)
+            last = min(end, segment.last_id)
+            if first <= last:
+                views.append(segment.view(first, last))
+        return views
+
+    def write_snapshot(self, seq, registry):
+        """Write the data of every client as of an event and start a new segment."""
+        self.flush()
+        path = os.path.join(self.path, "snapshot")
+        with open(path + ".tmp", "wb") as f:
+            f.write(json.dumps(dict(seq=seq)).encode("UTF-8") + b"\n")
+            for item in registry.values():
+                f.write(item + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        segments = self._segments
+        if not segments[-1].ends:
+            return  # nothing new to keep apart
+        segments[-1].close()
+        # Keep the last segment for clients reconnecting with older IDs.
+        for segment in segments[:-1]:
+            segment.remove()
+        del segments[:-1]
+        segment = Segment(self.path, seq + 1)
+        segment.open()
+        segments.append(segment)
+
+    def close(self):
+        """Write any pending events and close the journal."""
+        self.flush()
+        for segment in self._segments:
+            segment.close()
@@ -0,0 +1,40 @@
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allow something to happen at an average rate, with bursts.
+
+    The bucket holds up to `burst` tokens and gains `rate` tokens a second.
+    Each time something happens it takes a token.
+    """
+
+    __slots__ = ("rate", "burst", "clock", "tokens", "_updated")
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self):
+        """Take a token and return True, or return False if there isn't one."""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        """Return the seconds until a token will be available."""
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
@@ -0,0 +1,117 @@
+import bisect
+import collections
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds in seconds, from 10 microseconds to 10 seconds.
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+# Upper bounds in events, for queue depths.
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Count observations in fixed buckets.
+
+    Observing a value is a binary search and two additions, cheap enough for
+    hot paths.
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """Count a value in the first bucket it fits in."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        """Return the histogram in the Prometheus text format."""
+        name = self.name
+        lines = [
+            "# HELP {} {}".format(name, self.help),
+            "# TYPE {} histogram".format(name),
+        ]
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, _format_value(bound), total))
+        lines.append("{}_sum {}".format(name, _format_value(self.sum)))
+        lines.append("{}_count {}".format(name, total))
+        return lines
+
+
+class Metrics:
+    """A server's metrics, rendered in the Prometheus text format.
+
+    Histograms are updated as things happen. Counters are read from the
+    server's `stats`, and gauges from callables, only when rendered.
+    Bucketed gauges count the values a callable returns at or below each
+    bound; unlike a histogram's, their counts can go down.
+    """
+
+    def __init__(self, prefix="aioserver"):
+        self.prefix = prefix
+        self.histograms = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.bucket_gauges = collections.OrderedDict()
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        """Return a new histogram."""
+        histogram = Histogram("{}_{}".format(self.prefix, name), help, buckets)
+        self.histograms[name] = histogram
+        return histogram
+
+    def gauge(self, name, help, function):
+        """Add a gauge whose value is returned by a function."""
+        self.gauges[name] = (help, function)
+
+    def bucket_gauge(self, name, help, function, buckets):
+        """Add gauges of how many of the values returned by a function fit in each bucket."""
+        self.bucket_gauges[name] = (help, function, tuple(buckets))
+
+    def render(self, stats=()):
+        """Return every metric in the Prometheus text format."""
+        prefix = self.prefix
+        lines = []
+        for key in sorted(stats):
+            name = "{}_{}_total".format(prefix, key)
+            lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(name, _format_value(stats[key])))
+        for key, (help, function) in self.gauges.items():
+            name = "{}_{}".format(prefix, key)
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, _format_value(function())))
+        for key, (help, function, buckets) in self.bucket_gauges.items():
+            name = "{}_{}".format(prefix, key)
+            counts = [0] * (len(buckets) + 1)
+            for value in function():
+                counts[bisect.bisect_left(buckets, value)] += 1
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} gauge".format(name))
+            total = 0
+            for bound, count in zip(buckets + (float("inf"),), counts):
+                total += count
+                lines.append('{}{{le="{}"}} {}'.format(name, _format_value(bound), total))
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        lines.append("")
+        return "\n".join(lines)
@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import gc
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+import click
+
+from .events import CommentEvent, Event, RetryEvent
+from .server import Client, Server, Subscription
+from .utils import json_dumps, json_encode
+
+
+logger = logging.getLogger(__name__)
+
+
+SAMPLE_DATA = dict(
+    id="1480000000000000",
+    color="rgba(12, 34, 56, 0.5)",
+    ip_address="127.0.0.1",
+    server="aioserver",
+    text="1480000000000000",
+    width=None
+)
+
+
+class NullResponse:
+    """A response that discards what's written to it."""
+
+    def write(self, data):
+        pass
+
+
+class MockTransport:
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 0)
+
+
+class MockRequest:
+    """Just enough of a request to create a client."""
+
+    transport = MockTransport()
+
+
+def add_client(server, client_id, **kwargs):
+    """Register a mock client as if it had connected, without a connection."""
+    client = Client(server, MockRequest(), **kwargs)
+    client.client_id = client_id
+    client._update({})
+    client.cursor = server.events.last_id
+    server.clients[client_id] = client
+    server.registry[client_id] = client.json
+    if client.subscription is not None:
+        server.subscribe(client)
+    return client
+
+
+def add_clients(server, count, subscribed=0.1):
+    """Register mock clients, a share of them with filtered subscriptions."""
+    log = server.events
+    every = int(1 / subscribed) if subscribed else 0
+    for i in range(count):
+        subscription = None
+        if every and 0 == i % every:
+            subscription = Subscription(client_ids=[SAMPLE_DATA['id']], maxsize=log.maxlen, loop=server.loop)
+        add_client(server, str(10**15 + i), subscription=subscription)
+
+
+def make_server(clients, loop):
+    server = Server("127.0.0.1", 0, loop=loop)
+    add_clients(server, clients)
+    return server
+
+
+def bench_event_encode():
+    return lambda: Event(SAMPLE_DATA, event_id="abc-1", event_type="updated").encode()
+
+
+def bench_comment_encode():
+    return lambda: CommentEvent("Howdy 1480000000000000!").encode()
+
+
+def bench_retry_encode():
+    return lambda: RetryEvent(10).encode()
+
+
+def bench_event_dump():
+    response = NullResponse()
+    return lambda: Event(SAMPLE_DATA, event_id="abc-1", event_type="updated").dump(response)
+
+
+def bench_json_encode():
+    return lambda: json_encode(SAMPLE_DATA)
+
+
+def bench_json_dumps():
+    return lambda: json_dumps(SAMPLE_DATA)
+
+
+def bench_add_event(clients, loop):
+    """Add an update to a server with mock clients."""
+    server = make_server(clients, loop)
+
+    def add_event():
+        loop.run_until_complete(server.add_event(Event(dict(SAMPLE_DATA), event_type="updated")))
+    return add_event
+
+
+def bench_fanout(clients, loop):
+    """Add an update and collect it for every mock client."""
+    server = make_server(clients, loop)
+    stream_clients = list(server.clients.values())
+
+    def fanout():
+        loop.run_until_complete(server.add_event(Event(dict(SAMPLE_DATA), event_type="updated")))
+        for client in stream_clients:
+            client.pending()
+    return fanout
+
+
+BENCHMARKS = collections.OrderedDict((
+    ('event_encode', bench_event_encode),
+    ('comment_encode', bench_comment_encode),
+    ('retry_encode', bench_retry_encode),
+    ('event_dump', bench_event_dump),
+    ('json_encode', bench_json_encode),
+    ('json_dumps', bench_json_dumps),
+))
+
+SERVER_BENCHMARKS = collections.OrderedDict((
+    ('add_event', bench_add_event),
+    ('fanout', bench_fanout),
+))
+
+
+def measure_memory(clients, loop):
+    """Return the bytes allocated for each mock client, counting its server state."""
+    server = Server("127.0.0.1", 0, loop=loop)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        add_clients(server, clients)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size / clients
+
+
+def measure(function, repeat=5, min_time=0.2):
+    """Return seconds per call for each of several timed runs.
+
+    The number of calls per run is calibrated so a run takes at least
+    `min_time`, and one untimed run warms up first.
+    """
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                function()
+            timings.append((time.perf_counter() - started) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return timings
+
+
+@click.command()
+@click.option('--benchmark', '-b', multiple=True, help="Only run benchmarks starting with this name")
+@click.option('--clients', '-c', multiple=True, type=int, default=(10, 1000, 100000), help="Mock clients for server benchmarks", show_default=True)
+@click.option('--repeat', '-r', default=5, help="Timed runs per benchmark", show_default=True)
+@click.option('--min-time', default=0.2, help="Minimum seconds per run", show_default=True)
+@click.option('--baseline', type=click.Path(dir_okay=False), help="JSON file of baseline timings")
+@click.option('--save', is_flag=True, help="Save these timings as the baseline")
+@click.option('--threshold', default=0.2, help="Fail if a result is this much worse than its baseline", show_default=True)
+def main(**options):
+    """Run micro-benchmarks of encoding, fan-out and memory per client.
+
+    With a baseline, exit with status 1 if any benchmark regressed.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    benchmarks = collections.OrderedDict()
+    for name, factory in BENCHMARKS.items():
+        benchmarks[name] = factory
+    for name, factory in SERVER_BENCHMARKS.items():
+        for clients in options['clients']:
+            benchmarks["{}_{}".format(name, clients)] = (lambda factory, clients: lambda: factory(clients, loop))(factory, clients)
+
+    memory_benchmarks = collections.OrderedDict(
+        ("client_bytes_{}".format(clients), clients) for clients in options['clients']
+    )
+
+    prefixes = options['benchmark']
+    if prefixes:
+        benchmarks = collections.OrderedDict(
+            (name, factory) for name, factory in benchmarks.items() if name.startswith(prefixes)
+        )
+        memory_benchmarks = collections.OrderedDict(
+            (name, clients) for name, clients in memory_benchmarks.items() if name.startswith(prefixes)
+        )
+
+    baseline = {}
+    if options['baseline'] and not options['save']:
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+
+    results = collections.OrderedDict()
+    regressions = []
+    threshold = options['threshold']
+
+    def report(name, value, line):
+        results[name] = value
+        if name in baseline:
+            change = value / baseline[name] - 1
+            line += "  {:+.1%}".format(change)
+            if change > threshold:
+                line += "  REGRESSED"
+                regressions.append(name)
+        click.echo(line)
+
+    for name, factory in benchmarks.items():
+        timings = measure(factory(), repeat=options['repeat'], min_time=options['min_time'])
+        median = statistics.median(timings)
+        report(name, median, "{:<24} {:>12.3f} us  +/- {:.3f}".format(name, median * 10**6, statistics.pstdev(timings) * 10**6))
+    for name, clients in memory_benchmarks.items():
+        size = measure_memory(clients, loop)
+        report(name, size, "{:<24} {:>12.0f} B".format(name, size))
+
+    loop.close()
+
+    if options['save']:
+        if not options['baseline']:
+            raise click.UsageError("--save needs --baseline")
+        with open(options['baseline'], 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if regressions:
+        click.echo("Regressed: {}".format(", ".join(regressions)), err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
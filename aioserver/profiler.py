@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+def _frame_name(code):
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _stack(frame):
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+class Profiler:
+    """Sample where a server's time goes, cheaply enough to leave on.
+
+    A CPU-time interval timer interrupts the process every `interval`
+    seconds of CPU used, and the stack is counted along with what the loop
+    was working on: the handler of the request being served, or else the
+    running coroutine. Separately, a watchdog thread notices when the event
+    loop hasn't run a callback for `slow_callback` seconds and counts the
+    stack that's holding it up, without the cost of the loop's debug mode.
+
+    Stacks are dumped in the folded format flame graph tools read, with
+    what the loop was working on as the root frame.
+    """
+
+    def __init__(self, interval=0.005, slow_callback=0.1, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.loop = loop
+        self.samples = collections.Counter()  # by (tag, stack)
+        self.stalls = collections.Counter()   # by (tag, stack), counted by the watchdog
+        self.tags = {}                        # handler names by task
+        self._thread_id = None
+        self._last_tick = None
+        self._tick_handle = None
+        self._stopped = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        """Start sampling, from the event loop's thread."""
+        self._thread_id = threading.get_ident()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        if self.slow_callback:
+            self._stopped.clear()
+            self._tick()
+            self._watchdog = threading.Thread(target=self._watch, name="aioserver-watchdog", daemon=True)
+            self._watchdog.start()
+
+    def stop(self):
+        """Stop sampling."""
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._tick_handle.cancel()
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _tag(self):
+        try:
+            task = current_task(loop=self.loop)
+        except RuntimeError:
+            task = None
+        if task is None:
+            return "loop"
+        tag = self.tags.get(task)
+        if tag is None:
+            coro = getattr(task, '_coro', None)
+            tag = getattr(coro, '__qualname__', None) or getattr(coro, '__name__', "task")
+        return tag
+
+    def _sample(self, signum, frame):
+        self.samples[self._tag(), _stack(frame)] += 1
+
+    def _tick(self):
+        self._last_tick = time.monotonic()
+        self._tick_handle = self.loop.call_later(self.slow_callback / 2, self._tick)
+
+    def _watch(self):
+        threshold = self.slow_callback
+        reported = False
+        while not self._stopped.wait(threshold / 2):
+            stalled = time.monotonic() - self._last_tick
+            if stalled <= threshold:
+                reported = False
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = _stack(frame)
+            self.stalls[self._tag(), stack] += 1
+            if not reported:
+                # Once per stall; later counts show how long it lasted.
+                reported = True
+                logger.warning("SLOW CALLBACK %.3fs in %s", stalled, " <- ".join(_frame_name(code) for code in reversed(stack[-5:])))
+
+    async def middleware(self, app, handler):
+        """Tag samples taken while a request is handled with the handler's name."""
+        tag = getattr(handler, '__name__', None) or "handler"
+        tags = self.tags
+        loop = self.loop
+
+        async def tagged(request):
+            task = current_task(loop=loop)
+            tags[task] = tag
+            try:
+                return await handler(request)
+            finally:
+                tags.pop(task, None)
+        return tagged
+
+    def dump(self):
+        """Return the counted stacks in the folded format.
+
+        Stacks counted by the watchdog are under a `slow:` root frame.
+        """
+        lines = []
+        for prefix, counter in (("", self.samples), ("slow:", self.stalls)):
+            # Copied in one go, since samples are added from a signal handler and a thread.
+            for (tag, stack), count in list(counter.items()):
+                frames = [prefix + tag]
+                frames.extend(_frame_name(code) for code in stack)
+                lines.append("{} {}".format(";".join(frames), count))
+        lines.sort()
+        lines.append("")
+        return "\n".join(lines)
+
+    def save(self, directory):
+        """Write the counted stacks to a new file in a directory and return its path."""
+        path = os.path.join(directory, "aioserver-{}-{}.folded".format(os.getpid(), int(time.time())))
+        with open(path, "w") as f:
+            f.write(self.dump())
+        logger.info("PROFILE %s", path)
+        return path
+
+    def reset(self):
+        """Forget every sample."""
+        self.samples.clear()
+        self.stalls.clear()
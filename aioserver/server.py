@@ -1,31 +1,277 @@
 import asyncio
 import collections
+import itertools
 import json
 import logging
+import math
+import operator
 import os
+import random
+import socket
+import sys
+import time
 
+import aiohttp
 from aiohttp import web
 from aiohttp.log import access_logger
 
-from .events import CommentEvent, Event, RetryEvent
-from .utils import generate_random_color, json_encode
+from .compression import CompressionBudget, Compressor, negotiate
+from .events import HEARTBEAT, CommentEvent, Event, RetryEvent, SnapshotEvent
+from .limits import TokenBucket
+from .metrics import DEPTH_BUCKETS, Metrics
+from .utils import content_etag, etag_matches, generate_random_color, json_dumps, set_socket_options
+from .websocket import PING_FRAME, TRY_AGAIN_LATER, close_frame, encode_event
 
 
 logger = logging.getLogger(__name__)
 
 
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+EVENT_TYPES = ("created", "updated", "deleted")
+
+# Headers sent with every stream, built once.
+STREAM_HEADERS = (
+    ('Access-Control-Allow-Credentials', "true"),
+    ('Access-Control-Allow-Headers', "Content-Type"),
+    ('Access-Control-Allow-Methods', "GET"),
+    ('Vary', "Accept-Encoding"),
+)
+
+
+class EventLog:
+    """A bounded, shared log of encoded events.
+
+    Every connected client reads the same log through its own cursor, so each
+    event is stored and encoded once no matter how many clients there are.
+    Event IDs are prefixed with an epoch so IDs from an earlier server, or
+    from another worker or shard started at the same moment, don't match
+    this one.
+
+    The log remembers the latest update for each client, so readers can skip
+    updates that a later update has already replaced, and the latest state,
+    so updates can be encoded as deltas.
+    """
+
+    def __init__(self, maxlen, epoch=None, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        if epoch is None:
+            # Random bits tell apart logs created in the same millisecond.
+            epoch = "{:x}.{}".format(int(time.time() * 1000), os.urandom(4).hex())
+        self.maxlen = maxlen
+        self.epoch = epoch
+        self.loop = loop
+        self.last_id = 0
+        self._events = collections.deque(maxlen=maxlen)
+        self._latest_updates = {}
+        self._states = {}  # (seq, event type, data) of the latest state of each client
+        self._waiter = None
+
+    def __len__(self):
+        return len(self._events)
+
+    @property
+    def first_id(self):
+        """Return the sequence number of the oldest retained event."""
+        return self.last_id - len(self._events) + 1
+
+    def format_id(self, seq):
+        """Return the event ID for a sequence number."""
+        return "{}-{}".format(self.epoch, seq)
+
+    def parse_id(self, event_id):
+        """Return the sequence number for an event ID from this log, or None."""
+        epoch, _, seq = (event_id or "").strip().rpartition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq > self.last_id:
+            return None
+        return seq
+
+    def append(self, event):
+        """Assign the next ID to an event, encode it and wake up readers."""
+        seq = self.last_id + 1
+        event.event_id = self.format_id(seq)
+        event.seq = seq
+        event.payload  # encode once, before any client reads it
+        self._events.append(event)
+        self.last_id = seq
+
+        event_type = event.event_type
+        data = event.data
+        client_id = data['id']
+        if "updated" == event_type:
+            self._latest_updates[client_id] = event
+        elif "deleted" == event_type:
+            self._latest_updates.pop(client_id, None)
+
+        if event_type in ("created", "updated"):
+            states = self._states
+            base = states.get(client_id)
+            if len(data) > 1:
+                if "updated" == event_type and base is not None and base[2].keys() == data.keys():
+                    event.base = base
+                states[client_id] = (seq, event_type, data)
+            else:
+                # Events from other nodes carry only encoded data.
+                states.pop(client_id, None)
+        elif "deleted" == event_type:
+            self._states.pop(client_id, None)
+
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            waiter.set_result(None)
+
+    def read(self, cursor, limit=None):
+        """Return up to `limit` of the retained events after a sequence number."""
+        available = min(self.last_id - cursor, len(self._events))
+        if available <= 0:
+            return []
+        count = available if limit is None else min(available, limit)
+        events = list(itertools.islice(reversed(self._events), available - count, available))
+        events.reverse()
+        return events
+
+    def superseded(self, event):
+        """Return True if a later update for the same client replaces an event."""
+        if "updated" != event.event_type:
+            return False
+        latest = self._latest_updates.get(event.data['id'])
+        return latest is not None and latest is not event
+
+    async def wait(self, cursor):
+        """Wait until there are events after a sequence number."""
+        while self.last_id <= cursor:
+            waiter = self._waiter
+            if waiter is None:
+                waiter = self.loop.create_future()
+                self._waiter = waiter
+            # Readers share one waiter; shield it so a cancelled reader
+            # doesn't cancel it for everybody else.
+            await asyncio.shield(waiter, loop=self.loop)
+
+
+def query_values(query, name):
+    """Return the values of a query parameter, repeated or comma-separated."""
+    return [value for values in query.getall(name, ()) for value in values.split(",") if value]
+
+
+class Subscription:
+    """The events a stream asked for, queued as they're added to the log.
+
+    Only streams that filter events have a subscription. The server indexes
+    subscriptions by client ID or event type, so adding an event only touches
+    the streams that want it.
+    """
+
+    __slots__ = ("event_types", "client_ids", "maxsize", "loop", "events", "dropped", "_waiter")
+
+    def __init__(self, event_types=(), client_ids=(), maxsize=1000, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.event_types = frozenset(event_types)
+        self.client_ids = frozenset(client_ids)
+        self.maxsize = maxsize
+        self.loop = loop
+        self.events = collections.deque()
+        self.dropped = 0
+        self._waiter = None
+
+    @classmethod
+    def from_query(cls, query, maxsize=1000, loop=None):
+        """Return a subscription for a request's query, or None for everything.
+
+        `type` and `id` may be repeated or comma-separated.
+        """
+        event_types = query_values(query, 'type')
+        client_ids = query_values(query, 'id')
+        if not event_types and not client_ids:
+            return None
+        if not set(event_types).issubset(EVENT_TYPES) or not all(map(str.isdigit, client_ids)):
+            raise ValueError("Invalid subscription")
+        return cls(event_types, client_ids, maxsize=maxsize, loop=loop)
+
+    @property
+    def topics(self):
+        """Return the index keys this subscription is found under."""
+        if self.client_ids:
+            return [('id', client_id) for client_id in self.client_ids]
+        return [('type', event_type) for event_type in self.event_types]
+
+    def matches(self, event):
+        """Return True if the subscription wants an event."""
+        event_types = self.event_types
+        if event_types and event.event_type not in event_types:
+            return False
+        client_ids = self.client_ids
+        return not client_ids or event.data['id'] in client_ids
+
+    def put(self, event):
+        """Queue an event, dropping the oldest one if the queue is full."""
+        events = self.events
+        if len(events) >= self.maxsize:
+            events.popleft()
+            self.dropped += 1
+        events.append(event)
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def wait(self):
+        """Wait until there are queued events."""
+        while not self.events:
+            waiter = self.loop.create_future()
+            self._waiter = waiter
+            try:
+                await waiter
+            finally:
+                self._waiter = None
+
+
 class Client:
-    """A connected client"""
+    """A connected client
+
+    There may be a great many of these, so they're kept small: no instance
+    dict and no reference to the request they came from.
+    """
+
+    __slots__ = (
+        "server", "transport", "subscription", "client_id", "ip_address", "data",
+        "cursor", "response", "compressor", "last_write", "bucket", "deferred",
+        "delta", "stale", "stale_before", "_json", "_etag",
+    )
 
     server_name = os.environ.get('USER', "aioserver")
 
-    def __init__(self, server, request):
+    heartbeat = HEARTBEAT.payload
+    payload_of = operator.attrgetter("payload")
+    delta_of = operator.attrgetter("delta_payload")
+
+    def __init__(self, server, request, subscription=None, delta=False):
+        transport = request.transport
         self.server = server
-        self.request = request
-        self.client_id = str(int(server.loop.time() * 10**6))              # time in microseconds
-        self.ip_address = request.transport.get_extra_info('peername')[0]  # remote IP from socket
+        self.transport = transport
+        self.subscription = subscription
+        self.client_id = str(int(server.loop.time() * 10**6))                 # time in microseconds
+        self.ip_address = sys.intern(transport.get_extra_info('peername')[0])  # remote IP from socket, shared
         self._update({})                                                   # initialize default data
-        self.queue = None
+        self.cursor = None
+        self.response = None
+        self.compressor = None
+        self.last_write = None
+        self.bucket = None
+        self.deferred = None  # handle of a delayed broadcast
+        if server.update_rate:
+            self.bucket = TokenBucket(server.update_rate, server.update_burst, clock=server.loop.time)
+        self.delta = delta
+        self.stale = set() if delta else None  # clients whose last sent state may be missing
+        self.stale_before = 0                   # sequence number before which states may be missing
 
     def _update(self, data):
         """Update data, ensuring required attributes aren't changed."""
@@ -39,11 +285,200 @@ class Client:
             width=data.get('width')
         )
         self.data = clean_data
+        self._json = None
+        self._etag = None
+
+    @property
+    def json(self):
+        """Return the encoded data, encoding it only once per update."""
+        json = self._json
+        if json is None:
+            json = json_dumps(self.data)
+            self._json = json
+        return json
+
+    @property
+    def etag(self):
+        """Return an entity tag for the encoded data, derived only once per update."""
+        etag = self._etag
+        if etag is None:
+            etag = content_etag(self.json)
+            self._etag = etag
+        return etag
 
     async def update(self, data):
-        """Update data and notify connected clients."""
+        """Update data and notify connected clients.
+
+        Return False if the client is over its update rate and the update
+        will be sent with a later broadcast, otherwise True.
+        """
         self._update(data)
-        await self.server.add_event(Event(self.data, event_type="updated"))
+        server = self.server
+        if not server.allow_update(self):
+            return False
+        await server.add_event(Event(self.data, event_type="updated", json=self.json))
+        return True
+
+    def resume(self, seq):
+        """Carry on after the last event an earlier connection was sent.
+
+        That connection may have skipped updates replaced by later ones, so
+        updates based on a state from before then are sent in full.
+        """
+        self.cursor = seq
+        self.stale_before = seq + 1
+
+    def write(self, payload):
+        """Write to the client's response and note when it was written."""
+        compressor = self.compressor
+        if compressor is not None:
+            payload = compressor.compress(payload)
+        self.response.write(payload)
+        server = self.server
+        server.stats['bytes_written'] += len(payload)
+        server.touch(self)
+
+    def retry_payload(self, wait):
+        """Return what to write to ask the client to reconnect after a while."""
+        return RetryEvent(wait).payload
+
+    def ready(self):
+        """Return True if there are events this client hasn't been sent."""
+        subscription = self.subscription
+        if subscription is not None:
+            return bool(subscription.events)
+        return self.cursor < self.server.events.last_id
+
+    async def wait(self):
+        """Wait until there are events this client hasn't been sent."""
+        subscription = self.subscription
+        if subscription is not None:
+            await subscription.wait()
+        else:
+            await self.server.events.wait(self.cursor)
+
+    def pending(self):
+        """Return the events this client hasn't been sent yet.
+
+        At most `Server.batch_size` events or about `Server.batch_bytes` bytes
+        are returned at once. Pending updates replaced by a later update for
+        the same client are left out. If the client fell so far behind that
+        events were lost, apply the server's overflow policy. Return None if
+        the client should be disconnected.
+        """
+        server = self.server
+        log = server.events
+        subscription = self.subscription
+        if subscription is None:
+            missed = log.first_id - 1 - self.cursor
+        else:
+            missed = subscription.dropped
+            subscription.dropped = 0
+
+        if missed > 0:
+            policy = server.overflow
+            if DISCONNECT == policy:
+                server.stats['clients_disconnected'] += 1
+                return None
+            server.stats['events_dropped'] += missed
+            if COALESCE == policy:
+                # Replace everything missed with the current state.
+                self.cursor = log.last_id
+                if subscription is None:
+                    return [server.snapshot()]
+                subscription.events.clear()
+                return [server.snapshot(subscription.client_ids)]
+            self.cursor = max(self.cursor, log.first_id - 1)
+            if self.delta:
+                if subscription is None:
+                    self.stale_before = log.first_id
+                else:
+                    queued = subscription.events
+                    self.stale_before = queued[0].seq if queued else log.last_id + 1
+
+        if subscription is None:
+            events = log.read(self.cursor, server.batch_size)
+        else:
+            queued = subscription.events
+            events = [queued.popleft() for _ in range(min(len(queued), server.batch_size))]
+
+        batch_bytes = server.batch_bytes
+        size = 0
+        for count, event in enumerate(events, 1):
+            size += len(event.payload)
+            if size >= batch_bytes:
+                if subscription is not None:
+                    subscription.events.extendleft(reversed(events[count:]))
+                del events[count:]
+                break
+        if subscription is None:
+            self.cursor += len(events)
+
+        # Only send the latest of several pending updates for the same client.
+        count = len(events)
+        if self.delta:
+            stale = self.stale
+            sent = []
+            for event in events:
+                if log.superseded(event):
+                    stale.add(event.data['id'])  # the later update's base won't be sent
+                else:
+                    sent.append(event)
+            events = sent
+        else:
+            events = [event for event in events if not log.superseded(event)]
+        if len(events) != count:
+            server.stats['events_coalesced'] += count - len(events)
+        return events
+
+    def encode(self, events):
+        """Return the payloads of events for this client, joined.
+
+        A delta stream is sent only the changed data of an update if it was
+        sent the state the update changes.
+        """
+        payload_of = self.payload_of
+        if not self.delta:
+            return b"".join(map(payload_of, events))
+
+        stale = self.stale
+        subscription = self.subscription
+        event_types = subscription.event_types if subscription is not None else ()
+        deltas = 0
+        parts = []
+        for event in events:
+            payload = payload_of(event)
+            event_type = event.event_type
+            if "snapshot" == event_type:
+                stale.clear()
+                self.stale_before = 0
+            else:
+                client_id = event.data['id']
+                base = event.base
+                if (
+                    base is not None
+                    and base[0] >= self.stale_before
+                    and client_id not in stale
+                    and (not event_types or base[1] in event_types)
+                ):
+                    payload = self.delta_of(event)
+                    deltas += 1
+                stale.discard(client_id)
+            parts.append(payload)
+        self.server.stats['deltas_sent'] += deltas
+        return b"".join(parts)
+
+    def close(self, payload=None):
+        """Close the client's connection, optionally writing something first.
+
+        Closing the transport ends the stream's handler, which then cleans up
+        as usual.
+        """
+        try:
+            if payload is not None and self.response is not None:
+                self.write(payload)
+        finally:
+            self.transport.close()
 
     async def __aenter__(self):
         """Notify connected clients of a newly opened connection."""
@@ -51,14 +486,12 @@ class Client:
         logger.info("OPEN %s %s", self.ip_address, client_id)
 
         server = self.server
-        queue = asyncio.Queue(loop=server.loop)
-
-        for client in server.clients.values():
-            await queue.put(Event(client.data, event_type="created"))
-
-        self.queue = queue
+        self.cursor = server.events.last_id
         server.clients[client_id] = self
-        await server.add_event(Event(self.data, event_type="created"))
+        server.ip_connections[self.ip_address] += 1
+        if self.subscription is not None:
+            server.subscribe(self)
+        await server.add_event(Event(self.data, event_type="created", json=self.json))
 
         return self
 
@@ -68,88 +501,763 @@ class Client:
         client_id = self.client_id
 
         del server.clients[client_id]
-        self.queue = None
+        server.writers.pop(client_id, None)
+        ip_connections = server.ip_connections
+        ip_connections[self.ip_address] -= 1
+        if not ip_connections[self.ip_address]:
+            del ip_connections[self.ip_address]
+        if self.deferred is not None:
+            self.deferred.cancel()
+            self.deferred = None
+        if self.subscription is not None:
+            server.unsubscribe(self)
+        self.cursor = None
+        self.response = None
+        self.compressor = None
 
         await self.server.add_event(Event(dict(id=client_id), event_type="deleted"))
         logger.info("CLOSE %s %s", self.ip_address, client_id)
 
 
+class WebSocketClient(Client):
+    """A client connected by WebSocket.
+
+    Each event is framed once and the same frame is written straight to
+    every client's transport. Updates arrive on the same socket.
+    """
+
+    __slots__ = ()
+
+    heartbeat = PING_FRAME
+    payload_of = operator.attrgetter("frame")
+    delta_of = operator.attrgetter("delta_frame")
+
+    def write(self, payload):
+        """Write to the client's transport and note when it was written."""
+        self.transport.write(payload)
+        server = self.server
+        server.stats['bytes_written'] += len(payload)
+        server.touch(self)
+
+    def retry_payload(self, wait):
+        """Return a close frame asking the client to reconnect after a while."""
+        return close_frame(TRY_AGAIN_LATER, "retry: {}".format(int(1000 * wait)))
+
+
+def encode_results(results):
+    """Return the response body for the results of a bulk update.
+
+    Results map client IDs to a status and the client's encoded data, or an
+    event with it. Data is only included for a successful status; another
+    node's reply to a failed update has none.
+    """
+    parts = []
+    for client_id, (status, data) in results.items():
+        if isinstance(data, Event):
+            data = data.json
+        if data and 200 <= status < 300:
+            item = b'{"data":%s,"status":%d}' % (data, status)
+        else:
+            item = b'{"status":%d}' % status
+        parts.append(json_dumps(client_id) + b":" + item)
+    return b"{" + b",".join(parts) + b"}\n"
+
+
 class Server:
     """An event source server"""
 
     timeout = 30
+    retry = 10
+    max_retry = 300
+    heartbeat_interval = 1
+    lag_interval = 1
+    rate_window = 1
 
-    def __init__(self, address, port, loop=None):
+    forward_timeout = 5
+
+    def __init__(self, address, port, log_size=1000, overflow=DROP_OLDEST,
+                 batch_size=100, batch_bytes=64 * 1024, flush_interval=0,
+                 compression_level=0, compression_window_bits=15, compression_budget=0.25,
+                 bus=None, journal=None, profiler=None, listen=True, reuse_port=False, backlog=100, tcp_nodelay=None, send_buffer=None,
+                 tcp_keepalive=None, keepalive_timeout=75, slow_request_timeout=0,
+                 reconnect_rate=0, retry_jitter=0.5, drain_time=10, drain_waves=10,
+                 max_connections=0, max_connections_per_ip=0, update_rate=0, update_burst=1, loop=None):
         if loop is None:
             loop = asyncio.get_event_loop()
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
         self.address = address
         self.port = port
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.compression_level = compression_level
+        self.compression_window_bits = compression_window_bits
+        self.bus = bus
+        self.journal = journal
+        self.profiler = profiler
+        self.listen = listen
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.tcp_nodelay = tcp_nodelay
+        self.send_buffer = send_buffer
+        self.tcp_keepalive = tcp_keepalive
+        self.keepalive_timeout = keepalive_timeout
+        self.slow_request_timeout = slow_request_timeout
+        self.reconnect_rate = reconnect_rate
+        self.retry_jitter = retry_jitter
+        self.drain_time = drain_time
+        self.drain_waves = drain_waves
+        self.draining = False
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.update_rate = update_rate
+        self.update_burst = update_burst
         self.loop = loop
         self.clients = collections.OrderedDict()
+        self.writers = collections.OrderedDict()  # streaming clients, least recently written first
+        self.events = EventLog(log_size, loop=loop)
+        self.stats = collections.Counter()
+        self.compression_budget = CompressionBudget(compression_budget, self.stats)
+        self.topics = collections.defaultdict(set)  # subscribed clients by ('id' or 'type', value)
+        self.registry = collections.OrderedDict()  # encoded data of every client, by client ID
+        self.owners = {}                           # bus node ID of clients connected to other nodes
+        self.ip_connections = collections.Counter()  # streams by remote IP
         self._server = None
+        self._handler = None
+        self._snapshot = None
+        self._tasks = []
+        self._requests = itertools.count(1)
+        self._replies = {}
+        self._rate_started = loop.time()
+        self._rate_opened = 0
+        self._connect_rate = 0
+
+        metrics = Metrics()
+        self.metrics = metrics
+        self._add_event_seconds = metrics.histogram('add_event_seconds', "Time to add events to the log, index and bus")
+        self._encode_seconds = metrics.histogram('encode_seconds', "Time to number and encode an event")
+        self._drain_seconds = metrics.histogram('drain_seconds', "Time streams wait for writes to drain")
+        self._loop_lag_seconds = metrics.histogram('loop_lag_seconds', "Delay of event loop callbacks")
+        metrics.bucket_gauge('queue_depth', "Streams with at most this many events waiting to be sent", self.queue_depths, DEPTH_BUCKETS)
+        metrics.gauge('clients', "Clients connected to this node", lambda: len(self.clients))
+        metrics.gauge('streams', "Streams being written to", lambda: len(self.writers))
+        metrics.gauge('registry_clients', "Clients connected to any node", lambda: len(self.registry))
+        metrics.gauge('log_events', "Events held in the log", lambda: len(self.events))
+        metrics.gauge('connect_rate', "Streams opened per second", lambda: self._connect_rate)
+        metrics.gauge('draining', "Whether this node is refusing new streams", lambda: int(self.draining))
 
     async def add_event(self, event):
-        """Add an event to the queue of each connected client."""
+        """Add an event to the shared event log and publish it to the bus."""
+        await self.add_events((event,))
+
+    async def add_events(self, events):
+        """Add events to the shared event log and publish them to the bus.
+
+        Appending never waits on a client, so a slow client can't hold up the
+        request that produced the events or any other client. Streams are
+        woken once for all the events. Publishing waits only if the bus is
+        backed up.
+        """
+        started = time.perf_counter()
+        bus = self.bus
+        for event in events:
+            self._append_event(event)
+            if bus is not None:
+                bus.publish(dict(type="event", event_type=event.event_type, id=event.data['id']), event.json)
+        self._add_event_seconds.observe(time.perf_counter() - started)
+        if bus is not None:
+            await bus.drain()
+
+    def _append_event(self, event):
+        started = time.perf_counter()
+        self.events.append(event)
+        self._encode_seconds.observe(time.perf_counter() - started)
+        self.stats['events_added'] += 1
+        journal = self.journal
+        if journal is not None:
+            journal.append(event)
+
+        # Only subscriptions indexed under the event's client or type are checked.
+        topics = self.topics
+        if topics:
+            for topic in (('id', event.data['id']), ('type', event.event_type)):
+                for client in topics.get(topic, ()):
+                    subscription = client.subscription
+                    if subscription.matches(event):
+                        subscription.put(event)
+
+        # Keep the registry and the snapshot in step with the clients.
+        event_type = event.event_type
+        if "deleted" == event_type:
+            self.registry.pop(event.data['id'], None)
+        elif event_type in ("created", "updated"):
+            self.registry[event.data['id']] = event.json
+        else:
+            return
+        self._snapshot = None
+
+    def receive(self, header, body):
+        """Handle a message from another node."""
+        message_type = header['type']
+        origin = header['origin']
+
+        if "event" == message_type:
+            # Events from other nodes arrive already encoded.
+            client_id = header['id']
+            event_type = header['event_type']
+            if "deleted" == event_type:
+                self.owners.pop(client_id, None)
+            else:
+                self.owners[client_id] = origin
+            self._append_event(Event(dict(id=client_id), event_type=event_type, json=body))
+
+        elif "hello" == message_type:
+            # Tell a new node about this node's clients.
+            self.announce_clients(to=origin)
+
+        elif "gone" == message_type:
+            # A node left; its clients are gone too.
+            self.forget_clients(origin)
+
+        elif "disconnected" == message_type:
+            # Cut off from every other node; their clients can't be reached.
+            self.forget_clients()
+
+        elif "connected" == message_type:
+            # Back after being cut off; the other nodes forgot this one's clients.
+            self.announce_clients()
+
+        elif "update" == message_type:
+            asyncio.ensure_future(self._apply_update(header, body), loop=self.loop)
+
+        elif "reply" == message_type:
+            reply = self._replies.get(header['request'])
+            if reply is not None and not reply.done():
+                reply.set_result((header['status'], body))
+
+    def announce_clients(self, to=None):
+        """Publish this node's clients, to one other node or to all of them."""
         for client in self.clients.values():
-            await client.queue.put(event)
+            header = dict(type="event", event_type="created", id=client.client_id)
+            if to is not None:
+                header['to'] = to
+            self.bus.publish(header, client.json)
+
+    def forget_clients(self, origin=None):
+        """Delete the clients connected to one other node, or to any other node."""
+        for client_id, owner in list(self.owners.items()):
+            if origin is None or owner == origin:
+                del self.owners[client_id]
+                self._append_event(Event(dict(id=client_id), event_type="deleted"))
+
+    async def _apply_update(self, header, body):
+        """Update a client on behalf of another node and reply with its data."""
+        reply = dict(type="reply", request=header['request'], to=header['origin'])
+        client = self.clients.get(header['id'])
+        if client is None:
+            reply['status'] = 404
+            self.bus.publish(reply)
+            return
+        updated = await client.update(json.loads(body.decode("UTF-8")))
+        reply['status'] = 200 if updated else 202
+        self.bus.publish(reply, client.json)
+
+    async def forward_update(self, client_id, data):
+        """Ask the node a client is connected to to update it.
+
+        Return the response status and the client's encoded data.
+        """
+        request_id = next(self._requests)
+        reply = self.loop.create_future()
+        self._replies[request_id] = reply
+        try:
+            self.bus.publish(
+                dict(type="update", id=client_id, request=request_id, to=self.owners[client_id]),
+                json_dumps(data)
+            )
+            return await asyncio.wait_for(reply, self.forward_timeout, loop=self.loop)
+        finally:
+            del self._replies[request_id]
+
+    def allow_update(self, client):
+        """Return True if a client's update may be broadcast now.
+
+        Otherwise a broadcast of the client's data is scheduled for when its
+        rate limit allows, unless one already is, so updates that arrive too
+        fast are merged into it instead of each being sent.
+        """
+        bucket = client.bucket
+        if bucket is None or (client.deferred is None and bucket.take()):
+            return True
+        if client.deferred is None:
+            client.deferred = self.loop.call_later(bucket.delay(), self._send_deferred, client)
+        self.stats['updates_deferred'] += 1
+        return False
+
+    def _send_deferred(self, client):
+        client.deferred = None
+        if client.cursor is None:
+            return  # closed since
+        if not client.bucket.take():
+            client.deferred = self.loop.call_later(client.bucket.delay(), self._send_deferred, client)
+            return
+        asyncio.ensure_future(self.add_event(Event(client.data, event_type="updated", json=client.json)), loop=self.loop)
+
+    def admit(self, request):
+        """Raise an HTTP error if a new stream would exceed a connection limit.
+
+        The limits apply to this server's own streams only; with several
+        workers or shards, each of them has its own.
+        """
+        max_connections = self.max_connections
+        if max_connections and len(self.clients) >= max_connections:
+            self.stats['streams_rejected'] += 1
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': str(math.ceil(self.retry_interval()))})
+        max_connections_per_ip = self.max_connections_per_ip
+        if max_connections_per_ip:
+            ip_address = request.transport.get_extra_info('peername')[0]
+            if self.ip_connections[ip_address] >= max_connections_per_ip:
+                self.stats['streams_rejected'] += 1
+                raise web.HTTPTooManyRequests(headers={'Retry-After': str(math.ceil(self.retry_interval()))})
+
+    def subscribe(self, client):
+        """Index a client's subscription."""
+        topics = self.topics
+        for topic in client.subscription.topics:
+            topics[topic].add(client)
+
+    def unsubscribe(self, client):
+        """Remove a client's subscription from the index."""
+        topics = self.topics
+        for topic in client.subscription.topics:
+            clients = topics.get(topic)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del topics[topic]
+
+    def touch(self, client):
+        """Note that a client was just written to."""
+        client.last_write = self.loop.time()
+        self.writers[client.client_id] = client
+        self.writers.move_to_end(client.client_id)
+
+    async def send_heartbeats(self):
+        """Periodically send a comment to every stream that's been idle too long.
+
+        Streams are ordered by when they were last written to, so each tick
+        only visits the streams that are actually idle.
+        """
+        loop = self.loop
+        writers = self.writers
+        while True:
+            await asyncio.sleep(self.heartbeat_interval, loop=loop)
+            deadline = loop.time() - self.timeout
+            while writers:
+                client = next(iter(writers.values()))
+                if client.last_write > deadline:
+                    break
+                try:
+                    client.write(client.heartbeat)  # moves the client to the end
+                except Exception:
+                    # Don't let one broken stream stop heartbeats for the rest.
+                    logger.warning("HEARTBEAT FAILED %s %s", client.ip_address, client.client_id, exc_info=True)
+                    writers.pop(client.client_id, None)
+                    continue
+                self.stats['heartbeats_sent'] += 1
+
+    def connect_rate(self):
+        """Return the rate streams were opened at over the last complete window."""
+        now = self.loop.time()
+        elapsed = now - self._rate_started
+        if elapsed >= self.rate_window:
+            opened = self.stats['streams_opened']
+            self._connect_rate = (opened - self._rate_opened) / elapsed
+            self._rate_started = now
+            self._rate_opened = opened
+        return self._connect_rate
+
+    def retry_interval(self):
+        """Return a reconnection delay to advertise, in seconds.
+
+        While streams are opened faster than `reconnect_rate`, the delay grows
+        in proportion, up to `max_retry`. It's jittered by `retry_jitter`, so
+        clients told to reconnect at the same time come back spread out.
+        """
+        retry = self.retry
+        reconnect_rate = self.reconnect_rate
+        if reconnect_rate:
+            retry = min(self.max_retry, retry * max(1, self.connect_rate() / reconnect_rate))
+        jitter = self.retry_jitter
+        # Rounded so encoded retry instructions can be shared.
+        return round(random.uniform(retry * max(0, 1 - jitter), retry * (1 + jitter)), 1)
+
+    async def drain(self, duration=None, waves=None):
+        """Stop accepting streams and close the open ones in waves.
+
+        New streams are refused with a 503 and a `Retry-After` header. Open
+        streams are sent a jittered retry instruction and closed a wave at a
+        time over `duration` seconds, so their clients don't all reconnect at
+        once. Other requests are still served.
+        """
+        if duration is None:
+            duration = self.drain_time
+        if waves is None:
+            waves = self.drain_waves
+        self.draining = True
+        clients = list(self.clients.values())
+        logger.info("DRAINING %d streams over %s seconds", len(clients), duration)
+
+        waves = max(1, min(waves, len(clients)))
+        for i in range(waves):
+            if i:
+                await asyncio.sleep(duration / waves, loop=self.loop)
+            for client in clients[i::waves]:
+                if client.cursor is None:
+                    continue  # already closed
+                try:
+                    client.close(client.retry_payload(self.retry_interval()))
+                except Exception:
+                    logger.warning("DRAIN FAILED %s %s", client.ip_address, client.client_id, exc_info=True)
+                    continue
+                self.stats['streams_drained'] += 1
+
+    def restore(self):
+        """Continue from the journal.
+
+        Event IDs carry on from the last journaled event. The clients the
+        journal knew about were connected before a restart, so they're
+        deleted; other nodes were already told when this one left.
+        """
+        journal = self.journal
+        log = self.events
+        journal.open(log.epoch)
+        log.epoch = journal.epoch
+        log.last_id = journal.last_id
+        for client_id in journal.registry:
+            self._append_event(Event(dict(id=client_id), event_type="deleted"))
+        journal.registry.clear()
+
+    async def write_journal_snapshots(self):
+        """Periodically write a snapshot of the registry to the journal."""
+        journal = self.journal
+        while True:
+            await asyncio.sleep(journal.snapshot_interval, loop=self.loop)
+            journal.write_snapshot(self.events.last_id, self.registry)
+
+    def compressor(self, request):
+        """Return a compressor for a stream, or None if it shouldn't be compressed."""
+        if not self.compression_level:
+            return None
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None or not self.compression_budget.allows():
+            return None
+        return Compressor(
+            encoding,
+            level=self.compression_level,
+            window_bits=self.compression_window_bits,
+            stats=self.stats
+        )
+
+    async def sample_loop_lag(self):
+        """Periodically measure how late the event loop runs a callback."""
+        loop = self.loop
+        interval = self.lag_interval
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval, loop=loop)
+            self._loop_lag_seconds.observe(max(0, loop.time() - started - interval))
+
+    def queue_depths(self):
+        """Generate the number of events waiting to be sent to each stream."""
+        last_id = self.events.last_id
+        for client in self.writers.values():
+            subscription = client.subscription
+            yield last_id - client.cursor if subscription is None else len(subscription.events)
+
+    async def get_metrics(self, request):
+        """Respond to a request for metrics in the Prometheus text format."""
+        return web.Response(
+            headers={'Content-Type': "text/plain; version=0.0.4; charset=utf-8"},
+            body=self.metrics.render(self.stats).encode("UTF-8")
+        )
+
+    async def get_profile(self, request):
+        """Respond to a request for profile samples, as folded stacks.
+
+        With `reset=1`, the samples are forgotten once they're returned.
+        """
+        profiler = self.profiler
+        body = profiler.dump()
+        if "1" == request.GET.get('reset'):
+            profiler.reset()
+        return web.Response(content_type="text/plain", text=body)
+
+    def snapshot(self, client_ids=None):
+        """Return an event holding the data of every connected client.
+
+        The event is built from data encoded when it was last changed, and it's
+        reused until the next change. Its ID is the ID of the latest event. If
+        client IDs are given, only those clients are included.
+        """
+        if client_ids:
+            log = self.events
+            registry = self.registry
+            items = [registry[client_id] for client_id in client_ids if client_id in registry]
+            return SnapshotEvent(items, event_id=log.format_id(log.last_id))
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            log = self.events
+            snapshot = SnapshotEvent(list(self.registry.values()), event_id=log.format_id(log.last_id))
+            self._snapshot = snapshot
+        return snapshot
+
+    def open_stream(self, request, last_event_id=None, replay=False):
+        """Check that a stream may be opened and prepare what it starts with.
+
+        Return the stream's subscription, the sequence number to resume
+        after, the events to send first and whether updates are sent as
+        deltas. If `replay` is true, an unfiltered stream may resume from
+        further back than the log goes, if the journal has the events.
+        """
+        if self.draining:
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': str(math.ceil(self.retry_interval()))})
+        self.admit(request)
+
+        log = self.events
+        try:
+            subscription = Subscription.from_query(request.GET, maxsize=log.maxlen, loop=self.loop)
+        except ValueError:
+            raise web.HTTPBadRequest()
+
+        last_seq = log.parse_id(last_event_id)
+        if last_seq is not None and last_seq < log.first_id - 1:
+            journal = self.journal
+            if not (replay and subscription is None and journal is not None and journal.has(last_seq)):
+                last_seq = None  # too old to replay
+
+        # Capture existing clients before this one is added.
+        if last_seq is None:
+            initial_events = [self.snapshot(subscription and subscription.client_ids)]
+        else:
+            initial_events = []
+            if subscription is not None:
+                for event in log.read(last_seq):
+                    if subscription.matches(event):
+                        subscription.put(event)
+
+        self.stats['streams_opened'] += 1
+        delta = "1" == request.GET.get('delta')
+        return subscription, last_seq, initial_events, delta
+
+    def catch_up(self, client, last_seq):
+        """Send a resumed stream the events it missed from before the log's oldest.
+
+        They're written straight from the journal's mapped files. Without a
+        journal, the log may have moved on since the stream was opened; the
+        stream is then left behind it, for the overflow policy to deal with.
+        """
+        log = self.events
+        end = log.first_id - 1
+        journal = self.journal
+        if journal is None or last_seq >= end:
+            return
+        views = journal.read(last_seq, end)
+        if views is None:
+            client.write(self.snapshot().payload)
+            client.cursor = log.last_id
+        else:
+            for view in views:
+                client.write(view)
+            client.cursor = end
+            self.stats['events_replayed'] += end - last_seq
+
+    async def send_events(self, client):
+        """Write events to a client as they're added.
+
+        Return when the client falls too far behind and should be
+        disconnected.
+        """
+        flush_interval = self.flush_interval
+        response = client.response
+        while True:
+            # No timeout here: send_heartbeats keeps idle streams open.
+            if not client.ready():
+                await client.wait()
+                if flush_interval:
+                    # Give more events a chance to arrive for this batch.
+                    await asyncio.sleep(flush_interval, loop=self.loop)
+
+            events = client.pending()
+            if events is None:
+                logger.warning("OVERFLOW %s %s", client.ip_address, client.client_id)
+                return
+
+            # Write the whole batch at once and wait for it to drain.
+            if events:
+                client.write(client.encode(events))
+                started = time.perf_counter()
+                await response.drain()
+                self._drain_seconds.observe(time.perf_counter() - started)
 
     async def stream_events(self, request):
         """Respond to a request to stream events."""
+        subscription, last_seq, initial_events, delta = self.open_stream(
+            request, request.headers.get('Last-Event-ID'), replay=True
+        )
+
         response = web.StreamResponse()
         response.content_type = "text/event-stream"
-        response.headers.update({
-            'Access-Control-Allow-Credentials': "true",
-            'Access-Control-Allow-Headers': "Content-Type",
-            'Access-Control-Allow-Methods': "GET",
-            'Access-Control-Allow-Origin': request.headers.get('Origin', "*")
-        })
-
-        async with Client(self, request) as client:
+        headers = response.headers
+        headers.extend(STREAM_HEADERS)
+        headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', "*")
+
+        async with Client(self, request, subscription=subscription, delta=delta) as client:
             client_id = client.client_id
-            queue = client.queue
-            timeout = self.timeout
 
-            response.headers['id'] = client_id
+            if last_seq is not None:
+                client.resume(last_seq)
+
+            headers['id'] = client_id
+            compressor = self.compressor(request)
+            if compressor is not None:
+                headers['Content-Encoding'] = compressor.encoding
             response.start(request)
+            client.response = response
+            client.compressor = compressor
 
-            CommentEvent("Howdy {}!".format(client_id)).dump(response)
-            RetryEvent(10).dump(response)
+            initial_events[:0] = [CommentEvent("Howdy {}!".format(client_id)), RetryEvent(self.retry_interval())]
+            client.write(b"".join(event.payload for event in initial_events))
+
+            if last_seq is not None:
+                self.catch_up(client, last_seq)
 
             await response.drain()
 
-            while True:
-                try:
-                    event = await asyncio.wait_for(
-                        queue.get(),
-                        timeout
-                    )
-                except asyncio.TimeoutError:
-                    # Send something so the connection doesn't time out.
-                    event = CommentEvent()
-                event.dump(response)
-                await response.drain()
+            await self.send_events(client)
+            # The client fell too far behind; ask it to reconnect later.
+            client.write(client.retry_payload(self.retry_interval()))
 
         await response.write_eof()
         return response
 
-    async def get_data(self, request):
-        """Respond to a request for a connected client's data."""
-        client_id = request.match_info['client_id']
-        try:
-            client = self.clients[client_id]
-        except KeyError:
-            raise web.HTTPNotFound()
+    async def stream_websocket(self, request):
+        """Respond to a request to stream events and receive updates over a WebSocket.
+
+        Events are sent as text frames holding a JSON object with the event's
+        type, ID and data. Text frames received are JSON objects that update
+        the client's data.
+        """
+        subscription, last_seq, initial_events, delta = self.open_stream(request, request.GET.get('last_event_id'))
+
+        response = web.WebSocketResponse()
+        async with WebSocketClient(self, request, subscription=subscription, delta=delta) as client:
+            client_id = client.client_id
+
+            if last_seq is not None:
+                client.resume(last_seq)
+
+            response.start(request)
+            client.response = response
+
+            hello = encode_event("hello", json_dumps(dict(id=client_id)))
+            client.write(hello + b"".join(event.frame for event in initial_events))
+
+            sender = asyncio.ensure_future(self._send_websocket(client), loop=self.loop)
+            try:
+                while True:
+                    message = await response.receive()
+                    if aiohttp.WSMsgType.TEXT != message.type:
+                        break
+                    try:
+                        data = json.loads(message.data)
+                    except ValueError:
+                        data = None
+                    if not isinstance(data, dict):
+                        logger.warning("BAD MESSAGE %s %s", client.ip_address, client_id)
+                        continue
+                    await client.update(data)
+            finally:
+                sender.cancel()
+                try:
+                    await sender
+                except asyncio.CancelledError:
+                    pass
+                except Exception:
+                    logger.exception("SEND FAILED %s %s", client.ip_address, client_id)
+
+        return response
+
+    async def _send_websocket(self, client):
+        await self.send_events(client)
+        # The client fell too far behind; ask it to reconnect later.
+        client.close(client.retry_payload(self.retry_interval()))
+
+    def data_response(self, request, body, etag, status=200):
+        """Return a response with encoded data, or raise a 304 if the client has it."""
+        if 200 == status and etag_matches(request.headers.get('If-None-Match'), etag):
+            self.stats['data_not_modified'] += 1
+            raise web.HTTPNotModified(headers={'ETag': etag})
         return web.Response(
+            status=status,
+            headers={'ETag': etag},
             content_type="application/json",
-            text="{}\n".format(json_encode(client.data))
+            body=body + b"\n"
         )
 
-    async def set_data(self, request):
-        """Respond to a request to update a connected client's data."""
+    async def get_data(self, request):
+        """Respond to a request for a connected client's data.
+
+        The data is encoded once per update, and a request with a matching
+        If-None-Match header gets a 304.
+        """
         client_id = request.match_info['client_id']
         try:
             client = self.clients[client_id]
         except KeyError:
+            # The client may be connected to another node.
+            try:
+                body = self.registry[client_id]
+            except KeyError:
+                raise web.HTTPNotFound()
+            etag = content_etag(body)
+        else:
+            body = client.json
+            etag = client.etag
+        return self.data_response(request, body, etag)
+
+    async def get_bulk_data(self, request):
+        """Respond to a request for many clients' data at once.
+
+        Client IDs are given as `id`, repeated or comma-separated. The response
+        maps each client ID to its data, or to null if it isn't connected.
+        """
+        client_ids = query_values(request.GET, 'id')
+        if not client_ids:
+            raise web.HTTPBadRequest()
+
+        clients = self.clients
+        registry = self.registry
+        parts = []
+        for client_id in client_ids:
+            client = clients.get(client_id)
+            body = registry.get(client_id, b"null") if client is None else client.json
+            parts.append(json_dumps(client_id) + b":" + body)
+        body = b"{" + b",".join(parts) + b"}"
+        return self.data_response(request, body, content_etag(body))
+
+    async def set_data(self, request):
+        """Respond to a request to update a connected client's data.
+
+        The status is 202 if the client is over its update rate and the
+        update will be broadcast later.
+        """
+        client_id = request.match_info['client_id']
+        client = self.clients.get(client_id)
+        if client is None and client_id not in self.owners:
             raise web.HTTPNotFound()
 
         try:
@@ -160,33 +1268,176 @@ class Server:
         if not isinstance(data, dict):
             raise web.HTTPBadRequest()
 
-        await client.update(data)
+        if client is None:
+            # The client is connected to another node.
+            try:
+                status, body = await self.forward_update(client_id, data)
+            except asyncio.TimeoutError:
+                raise web.HTTPGatewayTimeout()
+            if status not in (200, 202):
+                raise web.HTTPNotFound()
+            etag = content_etag(body)
+        else:
+            status = 200 if await client.update(data) else 202
+            body = client.json
+            etag = client.etag
+        return web.Response(
+            status=status,
+            headers={'ETag': etag},
+            content_type="application/json",
+            body=body + b"\n"
+        )
+
+    async def set_bulk_data(self, request):
+        """Respond to a request to update many clients' data at once.
+
+        The request is a JSON object mapping client IDs to data. The response
+        maps each client ID to its status and, if it was updated, its data.
+        Updates to clients over their update rate are broadcast later, with
+        status 202.
+        """
+        try:
+            updates = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest()
+
+        if not isinstance(updates, dict):
+            raise web.HTTPBadRequest()
+
+        results = collections.OrderedDict()
+        events = []
+        forwarded = []
+        for client_id, data in updates.items():
+            if not isinstance(data, dict):
+                results[client_id] = (400, None)
+                continue
+            client = self.clients.get(client_id)
+            if client is not None:
+                client._update(data)
+                event = Event(client.data, event_type="updated", json=client.json)
+                if self.allow_update(client):
+                    events.append(event)
+                    results[client_id] = (200, event)
+                else:
+                    results[client_id] = (202, event)
+            elif client_id in self.owners:
+                forwarded.append(client_id)
+                results[client_id] = None
+            else:
+                results[client_id] = (404, None)
+
+        # Wake streams once for every local update.
+        await self.add_events(events)
+
+        # Clients connected to other nodes are updated concurrently.
+        replies = await asyncio.gather(
+            *(self.forward_update(client_id, updates[client_id]) for client_id in forwarded),
+            loop=self.loop,
+            return_exceptions=True
+        )
+        for client_id, reply in zip(forwarded, replies):
+            results[client_id] = (504, None) if isinstance(reply, Exception) else reply
+
         return web.Response(
             content_type="application/json",
-            text="{}\n".format(json_encode(client.data))
+            body=encode_results(results)
         )
 
+    def accept(self, sock):
+        """Serve a connection accepted by someone else, such as a `Listener`.
+
+        Call it from the server's own event loop.
+        """
+        if self._handler is None:
+            sock.close()
+            return
+        asyncio.ensure_future(self.loop.connect_accepted_socket(self._protocol, sock), loop=self.loop)
+
+    def _protocol(self):
+        """Return the HTTP handler for a new connection, setting TCP options once it's made.
+
+        The event loop and the handler set some options of their own on each
+        connection, so they're set after those.
+        """
+        protocol = self._handler()
+        connection_made = protocol.connection_made
+
+        def set_options(transport):
+            connection_made(transport)
+            sock = transport.get_extra_info('socket')
+            if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+                set_socket_options(sock, self.tcp_nodelay, self.send_buffer, self.tcp_keepalive)
+        protocol.connection_made = set_options
+        return protocol
+
     async def start(self):
-        """Start the server."""
-        assert self._server is None
+        """Start the server.
+
+        Unless `listen` is false, it accepts its own connections.
+        """
+        assert self._handler is None
         loop = self.loop
-        app = web.Application(loop=loop)
+        if self.journal is not None:
+            self.restore()
+        profiler = self.profiler
+        middlewares = [profiler.middleware] if profiler is not None else []
+        app = web.Application(loop=loop, middlewares=middlewares)
 
         app.router.add_route("GET", '/events', self.stream_events)
+        app.router.add_route("GET", '/ws', self.stream_websocket)
         app.router.add_route("GET", '/data/{client_id:\d+}', self.get_data)
         app.router.add_route("PUT", '/data/{client_id:\d+}', self.set_data)
+        app.router.add_route("GET", '/data', self.get_bulk_data)
+        app.router.add_route("PUT", '/data', self.set_bulk_data)
+        app.router.add_route("GET", '/metrics', self.get_metrics)
+        if profiler is not None:
+            app.router.add_route("GET", '/debug/profile', self.get_profile)
 
-        self._server = await loop.create_server(
-            app.make_handler(access_log=access_logger),
-            self.address,
-            self.port
+        handler = app.make_handler(
+            access_log=access_logger,
+            keepalive_timeout=self.keepalive_timeout,
+            slow_request_timeout=self.slow_request_timeout,
+            tcp_keepalive=self.tcp_keepalive is None or bool(self.tcp_keepalive)
         )
+        self._handler = handler
+        if self.listen:
+            self._server = await loop.create_server(
+                self._protocol,
+                self.address,
+                self.port,
+                backlog=self.backlog,
+                reuse_port=self.reuse_port or None
+            )
+        self._tasks = [
+            asyncio.ensure_future(self.send_heartbeats(), loop=loop),
+            asyncio.ensure_future(self.sample_loop_lag(), loop=loop),
+        ]
+        if self.journal is not None:
+            self._tasks.append(asyncio.ensure_future(self.write_journal_snapshots(), loop=loop))
+        if profiler is not None:
+            profiler.start()
+
+        bus = self.bus
+        if bus is not None:
+            await bus.connect(self.receive)
 
     async def stop(self):
         """Stop the server."""
+        assert self._handler is not None
+        self._handler = None
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.bus is not None:
+            await self.bus.close()
+        journal = self.journal
+        if journal is not None:
+            journal.write_snapshot(self.events.last_id, self.registry)
+            journal.close()
         server = self._server
-        assert server is not None
-        server.close()
-        await server.wait_closed()
-        server = None
-        self._server = server
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            self._server = None
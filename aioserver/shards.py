@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import logging
+import socket
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_loop(loop):
+    """Run an event loop in the current thread until it's stopped."""
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+
+
+class Shard:
+    """A server running on its own event loop in its own thread.
+
+    Apart from `start` and `stop`, only the loop's thread may touch the
+    server.
+    """
+
+    def __init__(self, server, name=None):
+        self.server = server
+        self.loop = server.loop
+        self.thread = threading.Thread(target=run_loop, args=(self.loop,), name=name, daemon=True)
+
+    def submit(self, coro):
+        """Run a coroutine on the shard's loop, returning a concurrent future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def start(self):
+        """Start the thread and the server."""
+        self.thread.start()
+        self.submit(self.server.start()).result()
+
+    def stop(self):
+        """Stop the server and the thread."""
+        self.submit(self.server.stop()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class Listener:
+    """Accept connections and hand them to shards in turn.
+
+    Connections are accepted on this listener's loop, so shards spend no
+    time accepting and none of them has to wake for a connection another
+    one takes. Each shard sets TCP options on the connections it's handed.
+    """
+
+    accept_delay = 1
+
+    def __init__(self, shards, address, port, backlog=100, reuse_port=False, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.shards = shards
+        self.address = address
+        self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.loop = loop
+        self.sock = None
+        self._next = itertools.cycle(shards)
+        self._resume = None
+
+    def start(self):
+        """Start accepting connections."""
+        assert self.sock is None
+        family, kind, proto, _, address = socket.getaddrinfo(
+            self.address, self.port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+        )[0]
+        sock = socket.socket(family, kind, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        self.sock = sock
+        self.loop.add_reader(sock.fileno(), self._accept)
+
+    def _accept(self):
+        sock = self.sock
+        # Take what's waiting, up to a backlog's worth, before going back to the loop.
+        for _ in range(self.backlog):
+            try:
+                conn, _ = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                # Out of file descriptors, most likely; wait for some to be closed.
+                logger.warning("ACCEPT FAILED %s", exc)
+                self.loop.remove_reader(sock.fileno())
+                self._resume = self.loop.call_later(self.accept_delay, self._resume_accepting)
+                return
+            conn.setblocking(False)
+            shard = next(self._next)
+            shard.loop.call_soon_threadsafe(shard.server.accept, conn)
+
+    def _resume_accepting(self):
+        self._resume = None
+        self.loop.add_reader(self.sock.fileno(), self._accept)
+
+    def stop(self):
+        """Stop accepting connections."""
+        sock = self.sock
+        assert sock is not None
+        if self._resume is not None:
+            self._resume.cancel()
+            self._resume = None
+        self.loop.remove_reader(sock.fileno())
+        sock.close()
+        self.sock = None
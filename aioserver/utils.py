@@ -1,6 +1,9 @@
+import collections
 import json
 import logging
 import random
+import socket
+import zlib
 
 
 logger = logging.getLogger(__name__)
@@ -16,6 +19,92 @@ def generate_random_color(range_min=0, range_max=255, alpha=0.5):
     )
 
 
+def _json_dumps_stdlib(data):
+    return json.dumps(data, separators=(',', ':'), sort_keys=True).encode("UTF-8")
+
+
+# Compact JSON encoders keyed by name. Optional backends are only available
+# if installed; all of them sort keys and never produce newlines.
+json_backends = collections.OrderedDict(json=_json_dumps_stdlib)
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    def _json_dumps_orjson(data):
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    json_backends['orjson'] = _json_dumps_orjson
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    def _json_dumps_ujson(data):
+        return ujson.dumps(data, sort_keys=True, escape_forward_slashes=False).encode("UTF-8")
+    json_backends['ujson'] = _json_dumps_ujson
+
+_json_dumps = _json_dumps_stdlib
+
+
+def set_json_backend(name):
+    """Select the JSON encoder used by `json_dumps` and `json_encode`."""
+    global _json_dumps
+    try:
+        _json_dumps = json_backends[name]
+    except KeyError:
+        raise ValueError("Unknown JSON backend: {}".format(name))
+    logger.debug("JSON backend %s", name)
+
+
+def json_dumps(data):
+    """Return the JSON-encoded bytes representation of a data object.
+
+    Data the selected backend can't encode, such as integers over 64 bits
+    or lone surrogates for orjson and ujson, is encoded with the standard
+    library instead.
+    """
+    try:
+        return _json_dumps(data)
+    except (TypeError, ValueError, OverflowError):
+        if _json_dumps is _json_dumps_stdlib:
+            raise
+        return _json_dumps_stdlib(data)
+
+
 def json_encode(data):
     """Return the JSON-encoded text representation of a data object."""
-    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+    return json_dumps(data).decode("UTF-8")
+
+
+def content_etag(body):
+    """Return an entity tag for some bytes, derived from their content."""
+    return '"{:08x}"'.format(zlib.crc32(body))
+
+
+def etag_matches(if_none_match, etag):
+    """Return True if an If-None-Match header value matches an entity tag."""
+    if not if_none_match:
+        return False
+    if "*" == if_none_match.strip():
+        return True
+    # Weak comparison, as If-None-Match calls for.
+    return any(tag.strip().lstrip("W/") == etag for tag in if_none_match.split(","))
+
+
+def set_socket_options(sock, nodelay=None, send_buffer=None, keepalive=None):
+    """Set TCP options on a connection's socket.
+
+    `keepalive` is the idle time in seconds before keep-alive probes are
+    sent; 0 turns keep-alive off.
+    """
+    if nodelay is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+    if send_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    if keepalive is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(keepalive)))
+        if keepalive and hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, keepalive // 3))
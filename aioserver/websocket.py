@@ -0,0 +1,49 @@
+import logging
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+
+# Opcodes
+TEXT = 0x1
+CLOSE = 0x8
+PING = 0x9
+
+# Close codes
+TRY_AGAIN_LATER = 1013
+
+_short_length = struct.Struct("!BBH")
+_long_length = struct.Struct("!BBQ")
+
+
+def encode_frame(data, opcode=TEXT):
+    """Return a final, unmasked frame, as a server sends."""
+    first = 0x80 | opcode
+    length = len(data)
+    if length < 126:
+        header = bytes((first, length))
+    elif length < 2**16:
+        header = _short_length.pack(first, 126, length)
+    else:
+        header = _long_length.pack(first, 127, length)
+    return header + data
+
+
+def close_frame(code, reason=""):
+    """Return a close frame."""
+    return encode_frame(struct.pack("!H", code) + reason.encode("UTF-8"), CLOSE)
+
+
+def encode_event(event_type, data, event_id=None):
+    """Return a text frame for an event: a JSON object with the event's type,
+    ID and already-encoded data.
+    """
+    parts = [b'{"data":', data, b',"event":"', event_type.encode("UTF-8"), b'"']
+    if event_id is not None:
+        parts.extend((b',"id":"', event_id.encode("UTF-8"), b'"'))
+    parts.append(b"}")
+    return encode_frame(b"".join(parts))
+
+
+PING_FRAME = encode_frame(b"", PING)
@@ -95,6 +95,12 @@ class ColorUpdater:
         with contextlib.closing(response):
             while True:
                 event_type, data = yield from self.next_event(response)
+                if "snapshot" == event_type:
+                    for item in data:
+                        client_url = urllib.parse.urljoin(self.base_url, client_path_template.format(client_id=item['id']))
+                        clients[client_url] = asyncio.ensure_future(self.update_client(client_url, item))
+                        logger.info("CREATED TASK %s", client_url)
+                    continue
                 client_url = urllib.parse.urljoin(self.base_url, client_path_template.format(client_id=data['id']))
                 if "created" == event_type:
                     clients[client_url] = asyncio.ensure_future(self.update_client(client_url, data))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3.5
 
 import asyncio
+import json
 import logging
 import aiohttp
 
@@ -67,11 +68,17 @@ class ScheduledUpdate:
         logger.info('MY CONNECTION ID %s', client_id);
         asyncio.async(self.update_client(http, client_id, interval), loop=loop)
 
+        snapshot = False
         while True:
             line = yield from response.content.readline()
             line = line.decode('UTF-8').strip()
 
-            if line.startswith('event: created'):
+            if line.startswith('event: snapshot'):
+                snapshot = True
+            elif snapshot and line.startswith('data: '):
+                self.connections = len(json.loads(line[len('data: '):]))
+                snapshot = False
+            elif line.startswith('event: created'):
                 self.connections += 1
             elif line.startswith('event: deleted'):
                 self.connections -= 1
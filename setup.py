@@ -20,6 +20,9 @@ setup(
     entry_points={
         'console_scripts': [
             'aioserver = aioserver.cli:main',
+            'aioserver-broker = aioserver.cli:broker_main',
+            'aioserver-bench = aioserver.bench:main',
+            'aioserver-microbench = aioserver.microbench:main',
         ],
     }
 )
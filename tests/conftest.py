@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+from aioserver import microbench
+from aioserver.events import Event
+from aioserver.server import Server
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def make_server(loop):
+    def make_server(**kwargs):
+        return Server("127.0.0.1", 0, loop=loop, **kwargs)
+    return make_server
+
+
+def add_client(server, client_id, **kwargs):
+    """Register a client as if it had connected, and add its created event."""
+    client = microbench.add_client(server, client_id, **kwargs)
+    server._append_event(Event(client.data, event_type="created", json=client.json))
+    return client
+
+
+def update(server, client, **data):
+    """Update a client's data and add the event, as `Client.update` does."""
+    client._update(dict(client.data, **data))
+    event = Event(client.data, event_type="updated", json=client.json)
+    server._append_event(event)
+    return event
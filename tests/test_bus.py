@@ -0,0 +1,117 @@
+import asyncio
+import os
+
+from aioserver.bus import Broker, Bus, MemoryBus, MemoryHub, listen
+from aioserver.events import Event
+
+from conftest import add_client
+
+
+def settle(loop, delay=0.05):
+    loop.run_until_complete(asyncio.sleep(delay, loop=loop))
+
+
+def connect(loop, *servers):
+    for server in servers:
+        loop.run_until_complete(server.bus.connect(server.receive))
+    settle(loop)
+
+
+def created(server, client_id):
+    """Add a client to a server and announce it, as a new stream does."""
+    client = add_client(server, client_id)
+    server.bus.publish(dict(type="event", event_type="created", id=client_id), client.json)
+    return client
+
+
+def test_memory_bus_shares_clients_and_events(make_server, loop):
+    hub = MemoryHub()
+    first = make_server(bus=MemoryBus(hub, loop=loop))
+    created(first, "1")
+    second = make_server(bus=MemoryBus(hub, loop=loop))
+    connect(loop, first, second)
+    # The second node joined after the client was added, and was told about it.
+    assert second.owners == {"1": first.bus.node_id}
+    assert second.registry["1"] == first.registry["1"]
+
+    loop.run_until_complete(first.add_event(Event(dict(id="1", text="a"), event_type="updated")))
+    settle(loop)
+    assert second.registry["1"] == b'{"id":"1","text":"a"}'
+    assert second.events.read(0)[-1].event_type == "updated"
+
+    loop.run_until_complete(first.bus.close())
+    settle(loop)
+    assert second.owners == {}
+    assert "1" not in second.registry
+
+
+def test_memory_bus_forwards_updates_to_the_owner(make_server, loop):
+    hub = MemoryHub()
+    first = make_server(bus=MemoryBus(hub, loop=loop))
+    second = make_server(bus=MemoryBus(hub, loop=loop))
+    connect(loop, first, second)
+    created(first, "1")
+    settle(loop)
+
+    status, body = loop.run_until_complete(second.forward_update("1", dict(text="b")))
+    assert status == 200
+    assert body == first.clients["1"].json
+    assert first.clients["1"].data['text'] == "b"
+
+
+def start_broker(loop, path):
+    broker = Broker(listen(path), loop=loop)
+    loop.run_until_complete(broker.start())
+    return broker
+
+
+def test_broker_tells_nodes_when_one_drops(make_server, loop, tmp_path):
+    path = str(tmp_path / "bus.sock")
+    broker = start_broker(loop, path)
+    first = make_server(bus=Bus(path, node_id="first", loop=loop))
+    second = make_server(bus=Bus(path, node_id="second", loop=loop))
+    connect(loop, first, second)
+    created(first, "1")
+    settle(loop)
+    assert second.owners == {"1": "first"}
+
+    # Without saying goodbye.
+    first.bus._receiver.cancel()
+    first.bus._writer.close()
+    settle(loop)
+    assert second.owners == {}
+    assert "1" not in second.registry
+
+    loop.run_until_complete(second.bus.close())
+    loop.run_until_complete(broker.stop())
+    settle(loop)
+
+
+def test_bus_reconnects_and_announces_its_clients(make_server, loop, tmp_path):
+    path = str(tmp_path / "bus.sock")
+    broker = start_broker(loop, path)
+    first = make_server(bus=Bus(path, node_id="first", loop=loop))
+    second = make_server(bus=Bus(path, node_id="second", loop=loop))
+    connect(loop, first, second)
+    created(first, "1")
+    created(second, "2")
+    settle(loop)
+
+    # The broker goes away; each node forgets the other's clients.
+    loop.run_until_complete(broker.stop())
+    for writer in list(broker.peers.values()):
+        writer.close()
+    settle(loop)
+    assert first.owners == {} and second.owners == {}
+    assert "2" not in first.registry
+
+    os.unlink(path)
+    broker = start_broker(loop, path)
+    settle(loop, Bus.reconnect_delay * 4)
+    assert first.owners == {"2": "second"}
+    assert second.owners == {"1": "first"}
+
+    for server in (first, second):
+        loop.run_until_complete(server.bus.close())
+    loop.run_until_complete(broker.stop())
+    settle(loop)
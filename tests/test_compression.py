@@ -0,0 +1,43 @@
+import collections
+import zlib
+
+import pytest
+
+from aioserver.compression import CompressionBudget, Compressor, negotiate
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ("gzip, deflate", 'gzip'),
+    ("deflate, gzip", 'gzip'),
+    ("DEFLATE", 'deflate'),
+    ("gzip;q=0, deflate;q=0.5", 'deflate'),
+    ("gzip; q=0.0", None),
+    ("gzip;q=nonsense", None),
+    ("br, identity", None),
+    ("", None),
+    (None, None),
+])
+def test_negotiate_prefers_gzip(accept_encoding, expected):
+    assert negotiate(accept_encoding) == expected
+
+
+@pytest.mark.parametrize('encoding, wbits', [('gzip', 16 + 15), ('deflate', 15)])
+def test_compressor_flushes_every_write(encoding, wbits):
+    stats = collections.Counter()
+    compressor = Compressor(encoding, stats=stats)
+    decompressor = zlib.decompressobj(wbits)
+    for data in (b"data: one\n\n", b"data: two\n\n"):
+        assert decompressor.decompress(compressor.compress(data)) == data
+    assert stats['compression_bytes_in'] == 22
+
+
+def test_budget_stops_new_compression_while_over_budget():
+    now = [0]
+    stats = collections.Counter()
+    budget = CompressionBudget(0.1, stats, window=10, clock=lambda: now[0])
+    assert budget.allows()
+    stats['compression_seconds'] += 2
+    now[0] = 10
+    assert not budget.allows()  # 20% of the last window
+    now[0] = 20
+    assert budget.allows()  # nothing spent since
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from aioserver.events import Event
+from aioserver.journal import Journal
+from aioserver.server import EventLog
+
+
+@pytest.fixture
+def log(loop):
+    return EventLog(100, epoch="1a2b.c3d4", loop=loop)
+
+
+def add(journal, log, event):
+    log.append(event)
+    journal.append(event)
+    return event
+
+
+def open_journal(path, loop, epoch="1a2b.c3d4"):
+    journal = Journal(str(path), loop=loop)
+    journal.open(epoch)
+    return journal
+
+
+def test_reopened_journal_restores_ids_and_clients(tmp_path, loop, log):
+    journal = open_journal(tmp_path, loop)
+    add(journal, log, Event(dict(id="1", text="a"), event_type="created"))
+    add(journal, log, Event(dict(id="2", text="b"), event_type="created"))
+    add(journal, log, Event(dict(id="1", text="c"), event_type="updated"))
+    add(journal, log, Event(dict(id="2"), event_type="deleted"))
+    journal.close()
+
+    journal = open_journal(tmp_path, loop, epoch="ffff.0000")
+    assert journal.epoch == "1a2b.c3d4"
+    assert journal.last_id == 4
+    assert dict(journal.registry) == {"1": b'{"id":"1","text":"c"}'}
+    journal.close()
+
+
+def test_reopened_journal_starts_from_its_snapshot(tmp_path, loop, log):
+    journal = open_journal(tmp_path, loop)
+    add(journal, log, Event(dict(id="1", text="a"), event_type="created"))
+    journal.write_snapshot(1, {"1": b'{"id":"1","text":"a"}'})
+    add(journal, log, Event(dict(id="2", text="b"), event_type="created"))
+    journal.close()
+
+    journal = open_journal(tmp_path, loop)
+    assert journal.last_id == 2
+    assert list(journal.registry) == ["1", "2"]
+    journal.close()
+
+
+def test_journal_drops_half_written_events(tmp_path, loop, log):
+    journal = open_journal(tmp_path, loop)
+    events = [add(journal, log, Event(dict(id=str(i), text="x"), event_type="created")) for i in range(3)]
+    journal.close()
+    segment = journal._segments[-1]
+    os.truncate(segment.events_path, os.path.getsize(segment.events_path) - 5)
+
+    journal = open_journal(tmp_path, loop)
+    assert journal.last_id == 2
+    assert list(journal.registry) == ["0", "1"]
+    assert os.path.getsize(segment.events_path) == len(events[0].payload) + len(events[1].payload)
+    journal.close()
+
+
+def test_journal_reads_payloads_across_segments(tmp_path, loop, log):
+    journal = open_journal(tmp_path, loop)
+    events = [add(journal, log, Event(dict(id="1", text=str(i)), event_type="updated")) for i in range(2)]
+    journal.write_snapshot(2, {})
+    events += [add(journal, log, Event(dict(id="1", text=str(i)), event_type="updated")) for i in range(2, 4)]
+
+    views = journal.read(1, 4)
+    assert b"".join(map(bytes, views)) == b"".join(event.payload for event in events[1:])
+    assert journal.read(1, 5) is None  # not added yet
+    assert journal.has(0)
+
+    # A second snapshot removes the segment before last.
+    journal.write_snapshot(4, {})
+    assert not journal.has(1)
+    assert journal.read(1, 4) is None
+    journal.close()
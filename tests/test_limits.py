@@ -0,0 +1,28 @@
+from aioserver.limits import TokenBucket
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_bursts_then_the_rate():
+    clock = Clock()
+    bucket = TokenBucket(2, burst=3, clock=clock)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    assert bucket.delay() == 0.5
+    clock.now = 0.5
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_bucket_holds_at_most_a_burst():
+    clock = Clock()
+    bucket = TokenBucket(2, burst=2, clock=clock)
+    clock.now = 60
+    assert [bucket.take() for _ in range(3)] == [True, True, False]
+    assert bucket.delay() == 0.5
@@ -0,0 +1,17 @@
+from aioserver.metrics import Metrics
+
+
+def test_bucket_gauge_counts_current_values():
+    values = [0, 3, 3, 50]
+    metrics = Metrics()
+    metrics.bucket_gauge('queue_depth', "Streams", lambda: values, (0, 5, 10))
+    lines = metrics.render().splitlines()
+    assert "# TYPE aioserver_queue_depth gauge" in lines
+    assert 'aioserver_queue_depth{le="0"} 1' in lines
+    assert 'aioserver_queue_depth{le="5"} 3' in lines
+    assert 'aioserver_queue_depth{le="+Inf"} 4' in lines
+
+    # Gauges go down when the values do.
+    values[:] = [0]
+    lines = metrics.render().splitlines()
+    assert 'aioserver_queue_depth{le="+Inf"} 1' in lines
@@ -0,0 +1,538 @@
+import asyncio
+import collections
+import json
+import socket
+
+import pytest
+from aiohttp import web
+
+from aioserver.events import Event
+from aioserver.microbench import MockRequest, NullResponse
+from aioserver.server import COALESCE, DISCONNECT, Client, EventLog, Subscription, encode_results, query_values
+
+from conftest import add_client, update
+
+
+def stream(server, **kwargs):
+    """Return a client streaming from the end of the log, as if just connected."""
+    client = Client(server, MockRequest(), **kwargs)
+    client.cursor = server.events.last_id
+    if client.subscription is not None:
+        server.subscribe(client)
+    return client
+
+
+def updated(client_id, **data):
+    return Event(dict(data, id=client_id), event_type="updated")
+
+
+class DataRequest:
+    """Just enough of a request for a client's data."""
+
+    def __init__(self, client_id, if_none_match=None):
+        self.match_info = dict(client_id=client_id)
+        self.headers = {} if if_none_match is None else {'If-None-Match': if_none_match}
+
+
+def test_log_keeps_only_recent_events(loop):
+    log = EventLog(3, loop=loop)
+    events = [updated(str(i)) for i in range(5)]
+    for event in events:
+        log.append(event)
+    assert (log.first_id, log.last_id, len(log)) == (3, 5, 3)
+    assert log.read(0) == events[2:]
+    assert log.read(3, limit=1) == [events[3]]
+    assert log.read(5) == []
+
+
+def test_log_parses_only_its_own_ids(loop):
+    log = EventLog(3, loop=loop)
+    other = EventLog(3, loop=loop)
+    log.append(updated("1"))
+    assert log.parse_id(log.format_id(1)) == 1
+    assert log.parse_id(log.format_id(2)) is None  # not added yet
+    assert log.parse_id(other.format_id(1)) is None
+    assert log.parse_id(None) is None
+
+
+def test_log_supersedes_all_but_the_latest_update(loop):
+    log = EventLog(10, loop=loop)
+    first, second, other = updated("1", text="a"), updated("1", text="b"), updated("2")
+    for event in (first, second, other):
+        log.append(event)
+    assert log.superseded(first)
+    assert not log.superseded(second)
+    assert not log.superseded(other)
+    log.append(Event(dict(id="1"), event_type="deleted"))
+    assert not log.superseded(first)
+
+
+def test_log_bases_updates_on_states_with_the_same_keys(loop):
+    log = EventLog(10, loop=loop)
+    created = Event(dict(id="1", text="a"), event_type="created")
+    log.append(created)
+    changed = updated("1", text="b")
+    log.append(changed)
+    assert changed.base == (1, "created", created.data)
+    reshaped = updated("1", text="c", color="red")
+    log.append(reshaped)
+    assert reshaped.base is None
+    remote = Event(dict(id="1"), event_type="updated", json=b'{"id":"1","text":"d"}')
+    log.append(remote)
+    after_remote = updated("1", text="e", color="red")
+    log.append(after_remote)
+    assert after_remote.base is None  # the remote state isn't known
+
+
+def test_pending_drops_oldest_events(make_server):
+    server = make_server(log_size=3)
+    client = stream(server)
+    for i in range(5):
+        server._append_event(updated(str(i)))
+    events = client.pending()
+    assert [event.seq for event in events] == [3, 4, 5]
+    assert server.stats['events_dropped'] == 2
+
+
+def test_pending_coalesces_into_a_snapshot(make_server):
+    server = make_server(log_size=3, overflow=COALESCE)
+    client = stream(server)
+    for i in range(5):
+        server._append_event(updated(str(i), text="x"))
+    events = client.pending()
+    assert [event.event_type for event in events] == ["snapshot"]
+    assert client.cursor == server.events.last_id
+
+
+def test_pending_disconnects_clients_that_fall_behind(make_server):
+    server = make_server(log_size=3, overflow=DISCONNECT)
+    client = stream(server)
+    for i in range(5):
+        server._append_event(updated(str(i)))
+    assert client.pending() is None
+    assert server.stats['clients_disconnected'] == 1
+
+
+def test_pending_limits_batches(make_server):
+    server = make_server(batch_size=2)
+    client = stream(server)
+    for i in range(3):
+        server._append_event(updated(str(i)))
+    assert len(client.pending()) == 2
+    assert len(client.pending()) == 1
+    assert client.pending() == []
+
+
+def test_delta_stream_sends_changes_to_states_it_was_sent(make_server):
+    server = make_server()
+    a = add_client(server, "1")
+    client = stream(server, delta=True)
+    update(server, a, text="one")
+    second = update(server, a, text="two")
+    events = client.pending()
+    assert events == [second]  # the first was replaced
+    assert client.encode(events) == second.payload  # its base wasn't sent
+    third = update(server, a, text="three")
+    events = client.pending()
+    assert client.encode(events) == third.delta_payload
+    assert b'"text":"three"' in third.delta_payload
+    assert b'"color"' not in third.delta_payload
+
+
+def test_delta_stream_sends_updates_in_full_after_dropping_events(make_server):
+    server = make_server(log_size=2)
+    a = add_client(server, "1")
+    client = stream(server, delta=True)
+    update(server, a, text="one")
+    others = [updated(str(i)) for i in (2, 3)]
+    for event in others:
+        server._append_event(event)
+    client.pending()
+    changed = update(server, a, text="two")
+    assert changed.base is not None
+    assert client.encode(client.pending()) == changed.payload
+
+
+def test_delta_stream_sends_updates_in_full_if_their_base_was_filtered_out(make_server, loop):
+    server = make_server()
+    a = add_client(server, "1")
+    update(server, a, text="one")
+    subscription = Subscription(event_types=["updated"], loop=loop)
+    client = stream(server, subscription=subscription, delta=True)
+    created = Event(dict(id="2", text="a"), event_type="created")
+    server._append_event(created)
+    changed = updated("2", text="b")
+    server._append_event(changed)
+    changed_again = update(server, a, text="two")
+    events = client.pending()
+    assert events == [changed, changed_again]
+    # The created event was filtered out; the update of a is based on an update.
+    assert client.encode([changed]) == changed.payload
+    assert client.encode([changed_again]) == changed_again.delta_payload
+
+
+def test_delta_stream_sends_deltas_after_a_snapshot(make_server):
+    server = make_server(log_size=2, overflow=COALESCE)
+    a = add_client(server, "1")
+    client = stream(server, delta=True)
+    for i in range(3):
+        update(server, a, text=str(i))
+    events = client.pending()
+    assert [event.event_type for event in events] == ["snapshot"]
+    client.encode(events)
+    changed = update(server, a, text="again")
+    assert client.encode(client.pending()) == changed.delta_payload
+
+
+def test_resumed_delta_stream_sends_skipped_bases_in_full(make_server):
+    server = make_server(batch_size=2)
+    a = add_client(server, "1")
+    b = add_client(server, "2")
+    first = Client(server, MockRequest(), delta=True)
+    first.cursor = server.events.last_id
+
+    update(server, a, text="one")
+    update(server, b, text="two")
+    changed = update(server, a, color="red")
+    assert changed.base is not None
+
+    # The first update of a is left out as replaced by the second.
+    events = first.pending()
+    assert [event.data['id'] for event in events] == ["2"]
+
+    second = Client(server, MockRequest(), delta=True)
+    second.resume(first.cursor)
+    events = second.pending()
+    assert events == [changed]
+    assert second.encode(events) == changed.payload  # it never got the text
+
+    later = update(server, a, width=3)
+    events = second.pending()
+    assert second.encode(events) == later.delta_payload
+
+
+def snapshot_ids(snapshot):
+    return [json.loads(item.decode("UTF-8"))["id"] for item in snapshot.items]
+
+
+def test_snapshot_is_reused_until_a_client_changes(make_server):
+    server = make_server()
+    a = add_client(server, "1")
+    add_client(server, "2")
+    snapshot = server.snapshot()
+    assert server.snapshot() is snapshot
+    assert snapshot.event_id == server.events.format_id(server.events.last_id)
+    assert snapshot_ids(snapshot) == ["1", "2"]
+    update(server, a, text="changed")
+    assert server.snapshot() is not snapshot
+    server._append_event(Event(dict(id="2"), event_type="deleted"))
+    assert snapshot_ids(server.snapshot()) == ["1"]
+
+
+def test_snapshot_of_some_clients(make_server):
+    server = make_server()
+    add_client(server, "1")
+    add_client(server, "2")
+    snapshot = server.snapshot(["2", "3"])
+    assert snapshot_ids(snapshot) == ["2"]
+
+
+class Query(list):
+    """Just enough of a query string, as pairs of names and values."""
+
+    def getall(self, name, default):
+        return [value for key, value in self if key == name] or default
+
+
+class BulkRequest:
+    """Just enough of a request for many clients' data."""
+
+    def __init__(self, query=(), body=None):
+        self.GET = Query(query)
+        self.headers = {}
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+def test_query_values_may_be_repeated_or_comma_separated():
+    query = Query([('id', "1,2"), ('id', "3"), ('id', ""), ('type', "created")])
+    assert query_values(query, 'id') == ["1", "2", "3"]
+    assert query_values(query, 'other') == []
+
+
+def test_subscription_from_query(loop):
+    assert Subscription.from_query(Query(), loop=loop) is None
+    subscription = Subscription.from_query(Query([('type', "created,deleted"), ('id', "1"), ('id', "2")]), loop=loop)
+    assert subscription.event_types == {"created", "deleted"}
+    assert subscription.client_ids == {"1", "2"}
+    assert sorted(subscription.topics) == [('id', "1"), ('id', "2")]
+    with pytest.raises(ValueError):
+        Subscription.from_query(Query([('type', "unknown")]), loop=loop)
+    with pytest.raises(ValueError):
+        Subscription.from_query(Query([('id', "abc")]), loop=loop)
+
+
+def test_only_matching_subscriptions_get_events(make_server, loop):
+    server = make_server()
+    by_id = stream(server, subscription=Subscription(client_ids=["1"], loop=loop))
+    by_type = stream(server, subscription=Subscription(event_types=["deleted"], loop=loop))
+    created = Event(dict(id="1"), event_type="created")
+    server._append_event(created)
+    server._append_event(Event(dict(id="2"), event_type="created"))
+    deleted = Event(dict(id="2"), event_type="deleted")
+    server._append_event(deleted)
+    assert list(by_id.subscription.events) == [created]
+    assert list(by_type.subscription.events) == [deleted]
+
+    server.unsubscribe(by_id)
+    server._append_event(Event(dict(id="1"), event_type="deleted"))
+    assert list(by_id.subscription.events) == [created]
+    assert ('id', "1") not in server.topics
+
+
+def test_bulk_data_maps_each_client_to_its_data(make_server, loop):
+    server = make_server()
+    client = add_client(server, "1")
+    server.registry["2"] = b'{"id":"2"}'  # connected to another node
+    response = loop.run_until_complete(server.get_bulk_data(BulkRequest([('id', "1,2"), ('id', "3")])))
+    assert json.loads(response.body.decode("UTF-8")) == {
+        "1": json.loads(client.json.decode("UTF-8")),
+        "2": dict(id="2"),
+        "3": None,
+    }
+
+
+def test_bulk_data_needs_a_client_id(make_server, loop):
+    server = make_server()
+    with pytest.raises(web.HTTPBadRequest):
+        loop.run_until_complete(server.get_bulk_data(BulkRequest([('id', ",")])))
+
+
+def test_bulk_update_reports_each_client(make_server, loop):
+    server = make_server()
+    add_client(server, "1")
+    last_id = server.events.last_id
+    request = BulkRequest(body={"1": dict(width=3), "2": dict(width=3), "3": "wide"})
+    response = loop.run_until_complete(server.set_bulk_data(request))
+    results = json.loads(response.body.decode("UTF-8"))
+    assert results["1"]["status"] == 200
+    assert results["1"]["data"]["width"] == 3
+    assert results["2"] == dict(status=404)
+    assert results["3"] == dict(status=400)
+    assert server.events.last_id == last_id + 1
+
+
+def test_bulk_results_leave_out_data_of_failed_updates():
+    body = encode_results(collections.OrderedDict((
+        ("1", (200, b'{"id":"1"}')),
+        ("2", (202, Event(dict(id="2"), event_type="updated"))),
+        ("3", (404, b"")),  # another node's reply
+        ("4", (504, None)),
+    )))
+    assert json.loads(body.decode("UTF-8")) == {
+        "1": dict(data=dict(id="1"), status=200),
+        "2": dict(data=dict(id="2"), status=202),
+        "3": dict(status=404),
+        "4": dict(status=504),
+    }
+
+
+def test_resumed_stream_behind_the_log_without_a_journal(make_server):
+    server = make_server(log_size=2)
+    server._append_event(updated("1"))
+    client = stream(server)
+    client.response = NullResponse()
+    # Resuming at the event before the oldest kept, then the log moves on.
+    last_seq = server.events.first_id - 1
+    server._append_event(updated("2"))
+    server._append_event(updated("3"))
+
+    client.resume(last_seq)
+    server.catch_up(client, last_seq)
+    events = client.pending()
+    assert [event.seq for event in events] == [2, 3]
+    assert server.stats['events_dropped'] == 1
+
+
+def test_data_etag_is_the_same_for_local_and_remote_clients(make_server, loop):
+    server = make_server()
+    client = add_client(server, "1")
+    local = loop.run_until_complete(server.get_data(DataRequest("1")))
+    # How another node holding the same client sees it.
+    other = make_server()
+    other.registry["1"] = client.json
+    remote = loop.run_until_complete(other.get_data(DataRequest("1")))
+    assert local.headers['ETag'] == remote.headers['ETag']
+    assert local.body == remote.body
+
+
+def test_data_etag_changes_with_the_data(make_server, loop):
+    server = make_server()
+    client = add_client(server, "1")
+    etag = client.etag
+    update(server, client, width=2)
+    assert client.etag != etag
+    response = loop.run_until_complete(server.get_data(DataRequest("1", if_none_match=etag)))
+    assert 200 == response.status
+
+
+def test_data_not_modified_if_the_client_has_it(make_server, loop):
+    server = make_server()
+    client = add_client(server, "1")
+    with pytest.raises(web.HTTPNotModified) as raised:
+        loop.run_until_complete(server.get_data(DataRequest("1", if_none_match=client.etag)))
+    assert raised.value.headers['ETag'] == client.etag
+    assert server.stats['data_not_modified'] == 1
+
+
+def test_retry_interval_is_jittered(make_server):
+    server = make_server(retry_jitter=0.5)
+    intervals = {server.retry_interval() for _ in range(100)}
+    assert all(5 <= interval <= 15 for interval in intervals)
+    assert len(intervals) > 1
+    assert make_server(retry_jitter=0).retry_interval() == server.retry
+
+
+def test_retry_interval_grows_with_the_connect_rate(make_server, loop):
+    server = make_server(reconnect_rate=10, retry_jitter=0)
+    server._rate_started = loop.time() - 1
+    server.stats['streams_opened'] += 30
+    assert server.retry_interval() == 3 * server.retry
+    server._rate_started = loop.time() - 1
+    server.stats['streams_opened'] += 1000
+    assert server.retry_interval() == server.max_retry
+
+
+class Response:
+    """A response that keeps what's written to it."""
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class Transport:
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_drain_closes_streams_in_waves_and_refuses_new_ones(make_server, loop):
+    server = make_server(retry_jitter=0)
+    clients = [add_client(server, str(i)) for i in range(4)]
+    for client in clients:
+        client.response = Response()
+        client.transport = Transport()
+    clients[3].cursor = None  # closed already
+
+    drained = loop.create_task(server.drain(duration=0.2, waves=2))
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert [client.transport.closed for client in clients] == [True, False, True, False]
+    with pytest.raises(web.HTTPServiceUnavailable):
+        server.open_stream(MockRequest())
+    loop.run_until_complete(drained)
+    assert [client.transport.closed for client in clients] == [True, True, True, False]
+    assert clients[0].response.written == [b"retry: 10000\n\n"]
+    assert server.stats['streams_drained'] == 3
+
+
+def test_admission_refuses_streams_over_the_server_limit(make_server):
+    server = make_server(max_connections=2)
+    add_client(server, "1")
+    server.admit(MockRequest())
+    add_client(server, "2")
+    with pytest.raises(web.HTTPServiceUnavailable) as raised:
+        server.admit(MockRequest())
+    assert int(raised.value.headers['Retry-After']) >= 1
+    assert server.stats['streams_rejected'] == 1
+
+
+def test_data_etag_is_the_same_for_local_and_remote_clients(make_server, loop):
+    server = make_server()
+    client = add_client(server, "1")
+    local = loop.run_until_complete(server.get_data(DataRequest("1")))
+    # How another node holding the same client sees it.
+    other = make_server()
+    other.registry["1"] = client.json
+    remote = loop.run_until_complete(other.get_data(DataRequest("1")))
+    assert local.headers['ETag'] == remote.headers['ETag']
+    assert local.body == remote.body
+
+
+def test_data_etag_changes_with_the_data(make_server, loop):
+    server = make_server()
+    client = add_client(server, "1")
+    etag = client.etag
+    update(server, client, width=2)
+    assert client.etag != etag
+    response = loop.run_until_complete(server.get_data(DataRequest("1", if_none_match=etag)))
+    assert 200 == response.status
+
+
+def test_data_not_modified_if_the_client_has_it(make_server, loop):
+    server = make_server()
+    client = add_client(server, "1")
+    with pytest.raises(web.HTTPNotModified) as raised:
+        loop.run_until_complete(server.get_data(DataRequest("1", if_none_match=client.etag)))
+    assert raised.value.headers['ETag'] == client.etag
+    assert server.stats['data_not_modified'] == 1
+
+
+def test_admission_refuses_streams_over_the_per_ip_limit(make_server):
+    server = make_server(max_connections_per_ip=1)
+    server.admit(MockRequest())
+    server.ip_connections["127.0.0.1"] += 1
+    with pytest.raises(web.HTTPTooManyRequests):
+        server.admit(MockRequest())
+    server.ip_connections["10.0.0.1"] += 1
+    del server.ip_connections["127.0.0.1"]
+    server.admit(MockRequest())
+
+
+def test_updates_over_the_rate_are_merged_into_a_later_broadcast(make_server, loop):
+    server = make_server(update_rate=50)
+    client = add_client(server, "1")
+    last_id = server.events.last_id
+    assert loop.run_until_complete(client.update(dict(text="one")))
+    assert not loop.run_until_complete(client.update(dict(text="two")))
+    assert not loop.run_until_complete(client.update(dict(text="three")))
+    assert server.events.last_id == last_id + 1
+    assert server.stats['updates_deferred'] == 2
+
+    loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+    assert server.events.last_id == last_id + 2
+    assert server.events.read(last_id + 1)[-1].data['text'] == "three"
+    assert client.deferred is None
+
+
+def test_tcp_options_are_set_on_each_connection(make_server, loop):
+    server = make_server(tcp_nodelay=False, tcp_keepalive=0)
+    transports = []
+
+    class Handler(asyncio.Protocol):
+        def connection_made(self, transport):
+            # What the event loop and aiohttp do to every connection.
+            sock = transport.get_extra_info('socket')
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            transports.append(transport)
+
+    server._handler = Handler
+    listener = loop.run_until_complete(loop.create_server(server._protocol, "127.0.0.1", 0))
+    port = listener.sockets[0].getsockname()[1]
+    _, writer = loop.run_until_complete(asyncio.open_connection("127.0.0.1", port, loop=loop))
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+
+    sock = transports[0].get_extra_info('socket')
+    assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) == 0
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0
+    writer.close()
+    transports[0].close()
+    listener.close()
+    loop.run_until_complete(listener.wait_closed())
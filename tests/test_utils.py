@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+from aioserver import utils
+from aioserver.utils import content_etag, etag_matches, json_backends, json_dumps, json_encode
+
+
+DATA = dict(id="1", text="\udc00", width=2 ** 70)
+
+
+def test_json_dumps_falls_back_to_stdlib(monkeypatch):
+    def reject(data):
+        raise OverflowError("int too big to convert")
+    monkeypatch.setattr(utils, '_json_dumps', reject)
+    assert json_dumps(DATA) == json_backends['json'](DATA)
+    assert json.loads(json_encode(DATA)) == DATA
+
+
+@pytest.mark.parametrize('name', list(json_backends))
+def test_json_backends_encode_what_stdlib_does(monkeypatch, name):
+    monkeypatch.setattr(utils, '_json_dumps', json_backends[name])
+    assert json.loads(json_dumps(DATA).decode("UTF-8")) == DATA
+
+
+def test_etag_matches_any_listed_tag_weakly():
+    etag = content_etag(b'{"id":"1"}')
+    assert etag_matches(etag, etag)
+    assert etag_matches('"other", W/' + etag, etag)
+    assert etag_matches(" * ", etag)
+    assert not etag_matches('"other"', etag)
+    assert not etag_matches("", etag)
+    assert not etag_matches(None, etag)
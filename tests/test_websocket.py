@@ -0,0 +1,48 @@
+import json
+import struct
+
+import pytest
+
+from aioserver.events import Event
+from aioserver.websocket import CLOSE, TEXT, TRY_AGAIN_LATER, close_frame, encode_event, encode_frame
+
+
+def decode_frame(frame):
+    """Return the opcode and payload of an unmasked frame."""
+    first, length = frame[0], frame[1]
+    assert first & 0x80  # final
+    assert not length & 0x80  # unmasked
+    offset = 2
+    if 126 == length:
+        length, = struct.unpack("!H", frame[2:4])
+        offset = 4
+    elif 127 == length:
+        length, = struct.unpack("!Q", frame[2:10])
+        offset = 10
+    payload = frame[offset:]
+    assert len(payload) == length
+    return first & 0x0f, payload
+
+
+@pytest.mark.parametrize('length', [0, 125, 126, 2**16 - 1, 2**16])
+def test_frame_lengths(length):
+    data = b"x" * length
+    assert decode_frame(encode_frame(data)) == (TEXT, data)
+
+
+def test_close_frame_holds_code_and_reason():
+    opcode, payload = decode_frame(close_frame(TRY_AGAIN_LATER, "retry: 1000"))
+    assert CLOSE == opcode
+    assert payload == struct.pack("!H", TRY_AGAIN_LATER) + b"retry: 1000"
+
+
+def test_event_frame_is_a_json_object():
+    opcode, payload = decode_frame(encode_event("updated", b'{"id":"1"}', "abc-1"))
+    assert TEXT == opcode
+    assert json.loads(payload.decode("UTF-8")) == dict(data=dict(id="1"), event="updated", id="abc-1")
+
+
+def test_event_is_framed_once():
+    event = Event(dict(id="1"), event_id="abc-1", event_type="updated")
+    assert event.frame is event.frame
+    assert event.frame == encode_event("updated", event.json, "abc-1")